@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+"""
+Compares speed of HTML table extraction engines of elektronabijecky.clean_data.
+
+Pages are either saved Evmapy stats pages (*.html in directory given by
+--pages) or pages rebuilt from committed backup CSVs, one per month, station
+and socket, with the same layout as Evmapy uses.
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import requests
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root + '/elektronabijecky')
+import elektronabijecky
+from sources import page_from_rows, evmapy_tables
+
+def synthetic_pages(padding):
+    """Rebuilds pages from backup CSVs"""
+    return [page_from_rows(rows, padding).encode('utf-8') for rows in evmapy_tables().values()]
+
+def response(content):
+    r = requests.Response()
+    r.status_code = 200
+    r.encoding = 'utf-8'
+    r._content = content
+    return r
+
+def measure(func, responses, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for r in responses:
+            func(r)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+parser = argparse.ArgumentParser(description='Benchmark elektronabijecky.clean_data engines')
+parser.add_argument('--pages', action='store', help='directory with saved Evmapy stats pages (*.html)')
+parser.add_argument('--padding', action='store', type=int, default=200, help='menu and footer items of rebuilt pages')
+parser.add_argument('-r', '--repeat', action='store', type=int, default=5, help='number of repetitions, best is reported')
+args = parser.parse_args()
+
+if args.pages:
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(args.pages, '*.html'))):
+        with open(filename, 'rb') as f:
+            pages.append(f.read())
+else:
+    pages = synthetic_pages(args.padding)
+responses = [response(page) for page in pages]
+
+elektronabijecky.config = {}
+for r in responses:
+    legacy = elektronabijecky.clean_data_bs4(r)
+    legacy = legacy if legacy == 1 else [row[:2] for row in legacy]
+    if elektronabijecky.clean_data(r) != legacy:
+        sys.exit('Engines differ on page of %s bytes' % len(r.content))
+
+megabytes = sum(len(page) for page in pages) / 2**20
+legacy = measure(elektronabijecky.clean_data_bs4, responses, args.repeat)
+current = measure(elektronabijecky.clean_data, responses, args.repeat)
+print('%d pages, %.1f MB' % (len(pages), megabytes))
+print('%-22s %8.3f s %8.1f MB/s' % ('BeautifulSoup (bs4)', legacy, megabytes / legacy))
+print('%-22s %8.3f s %8.1f MB/s' % ('lxml iterparse', current, megabytes / current))
+print('speedup %.1fx' % (legacy / current))
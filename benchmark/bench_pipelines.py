@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+"""
+Measures monthly and full backfill runs of import scripts against local
+stand-ins of data sources and CKAN (see sources.py), nothing is sent to
+evmapy.cz, data.zdarns.cz, deska.zdarns.cz nor CKAN.
+
+Every run uses fresh copy of scripts with configs pointing to stand-ins, so
+caches, manifests and catalogs are cold. Reported are wall time, requests
+and bytes of data sources and CKAN and peak memory of script process.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import toml
+
+from sources import Sources, root
+
+PIPELINES = ['elektronabijecky', 'teplota', 'uredni-deska']
+
+def configs(url, workers):
+    """Configs of scripts pointing to stand-ins"""
+    common = {
+        'url': url,
+        'url_api': url + 'api/action/',
+        'apikey': 'bench',
+        'owner_org': 'bench',
+        'resource_iri': 'https://data.zdarns.cz/zdroj/',
+        'cache_dir': '../.cache',
+    }
+    elektronabijecky = dict(common, **{
+        'post_login_url': url + 'users_login.php',
+        'request_url': url + 'muj-ucet?action=stats',
+        'package': 'vyuziti-elektronabijecek-',
+        'package_name': 'Využití elektronabíječek v roce ',
+        'filename': 'backup/elektronabijecky_',
+        'extension': '.csv',
+        'table_head': ['nabijeci_stanice', 'nabijeni_interval_zacatek_datum_a_cas',
+                       'nabijeni_interval_konec_datum_a_cas', 'spotreba_hodnota', 'spotreba_jednotka'],
+        'cookie_jar': '.evmapy_cookies',
+        'workers': workers or 4,
+        'station_dict': {'319': 'centrální-parkoviště', '351': 'stará-radnice'},
+        'socket_dict': {'343': 'konektor-2-mennekes-22kw', '344': 'zasuvka-230v', '391': 'stojan-1'},
+        'payload': {'em': 'bench', 'ps': 'bench'},
+    })
+    teplota = dict(common, **{
+        'request_url': url + 'temp.asp?P=bench&F=T',
+        'package': 'historie-teploty-',
+        'package_name': 'Historie teploty v roce ',
+        'filename': 'backup/teploty_',
+        'extension': '.csv',
+        'table_head': ['datum_a_cas_mereni', 'cidlo', 'nazev_cidla', 'teplota', 'jednotka', 'zemepisna_delka',
+                       'zemepisna_sirka'],
+        'workers': workers or 1,
+        # Waiting for ingestion would be measured otherwise
+        'datapusher': False,
+    })
+    for senzor, (lat, long) in {'senzor1': ('49.56', '15.93'), 'senzor2': ('49.57', '15.94')}.items():
+        teplota[senzor + '-name'] = senzor
+        teplota[senzor + '-iri'] = 'https://data.zdarns.cz/zdroj/' + senzor
+        teplota[senzor + '-lat'] = lat
+        teplota[senzor + '-long'] = long
+    uredni_deska = dict(common, **{
+        'request_url': url + 'export.asp',
+        'package': 'hlasovani-mestskeho-zastupitelstvi-',
+        'package_name': 'Výsledky hlasování městského zastupitelství ',
+        'filename': 'backup/hlasovani-mestskeho-zastupitelstvi-',
+        'extension': '.xml',
+        'state_file': '.ID',
+        'workers': workers or 4,
+    })
+    return {'elektronabijecky': elektronabijecky, 'teplota': teplota, 'uredni-deska': uredni_deska}
+
+def scenarios(sources, backfill_years):
+    """Yields (pipeline, run, arguments) of every measured run"""
+    periods = sorted(period for period, station, socket in sources.tables)
+    first, last = periods[0], periods[-1]
+    end_year, end_month = int(last[:4]), int(last[4:])
+    monthly = ['-sy', str(end_year), '-sm', str(end_month), '-ey', str(end_year), '-em', str(end_month), '--no-head']
+
+    yield 'elektronabijecky', 'monthly', monthly
+    yield 'elektronabijecky', 'backfill', ['-sy', first[:4], '-sm', str(int(first[4:])),
+                                           '-ey', str(end_year), '-em', str(end_month), '--head']
+    yield 'teplota', 'monthly', monthly
+    yield 'teplota', 'backfill', ['-sy', str(end_year - backfill_years + 1), '-sm', '1',
+                                  '-ey', str(end_year), '-em', str(end_month), '--head']
+    newest = Sources.FIRST_SESSION_ID + len(sources.sessions) - 1
+    yield 'uredni-deska', 'monthly', ['--discover']
+    yield 'uredni-deska', 'backfill', ['-sid', str(Sources.FIRST_SESSION_ID), '-eid', str(newest)]
+
+def prepare(directory, pipeline, config):
+    """Copies script and shared package into directory, backup of script is kept as seed"""
+    ignore = shutil.ignore_patterns('__pycache__', '*.log', 'config.toml', '.cache')
+    shutil.copytree(os.path.join(root, 'common'), os.path.join(directory, 'common'), ignore=ignore)
+    location = os.path.join(directory, pipeline)
+    shutil.copytree(os.path.join(root, pipeline), location, ignore=ignore)
+    os.makedirs(os.path.join(location, 'backup'), exist_ok=True)
+    with open(os.path.join(location, 'config.toml'), 'w', encoding='utf-8') as f:
+        toml.dump(config, f)
+    return location
+
+def measure(location, pipeline, arguments):
+    """Runs script, returns exit code, wall time and peak memory in bytes"""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(location, pipeline + '.py')] + arguments,
+                               cwd=location)
+    pid, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux
+    return process.returncode, wall, usage.ru_maxrss * 1024
+
+parser = argparse.ArgumentParser(description='Benchmark import scripts against local stand-ins of sources and CKAN')
+parser.add_argument('pipelines', nargs='*', default=PIPELINES, help='scripts to measure (default: all)')
+parser.add_argument('--runs', nargs='+', choices=['monthly', 'backfill'], default=['monthly', 'backfill'],
+                    help='runs to measure (default: both)')
+parser.add_argument('--scale', action='store', type=int, default=1,
+                    help='multiplies rows of temperature exports and stats pages')
+parser.add_argument('--latency', action='store', type=float, default=0, help='delay of data source responses in ms')
+parser.add_argument('--ckan-latency', action='store', type=float, default=0, help='delay of CKAN responses in ms')
+parser.add_argument('--padding', action='store', type=int, default=200, help='menu and footer items of stats pages')
+parser.add_argument('--backfill-years', action='store', type=int, default=2, help='years of teplota backfill')
+parser.add_argument('-w', '--workers', action='store', type=int, help='workers of scripts (default as in templates)')
+parser.add_argument('--json', action='store', help='write results also into JSON file')
+args = parser.parse_args()
+
+sources = Sources(args.scale, args.latency / 1000, args.ckan_latency / 1000, args.padding)
+url = sources.start()
+pipeline_configs = configs(url, args.workers)
+
+results = []
+print('%-16s %-8s %3s %8s %8s %10s %8s %10s %8s' % ('script', 'run', 'rc', 'wall s', 'src req', 'src MB',
+                                                    'ckan req', 'ckan MB', 'peak MB'))
+for pipeline, run, arguments in scenarios(sources, args.backfill_years):
+    if pipeline not in args.pipelines or run not in args.runs:
+        continue
+    sources.reset()
+    with tempfile.TemporaryDirectory(prefix='bench-') as directory:
+        location = prepare(directory, pipeline, pipeline_configs[pipeline])
+        if pipeline == 'uredni-deska':
+            # Monthly run finds one new session, backfill doesn't use state file
+            with open(os.path.join(location, '.ID'), 'w') as f:
+                f.write(str(Sources.FIRST_SESSION_ID + len(sources.sessions) - 1) + '\n')
+        code, wall, peak = measure(location, pipeline, arguments)
+
+    groups = sources.report()
+    result = {
+        'script': pipeline,
+        'run': run,
+        'arguments': arguments,
+        'exit_code': code,
+        'wall_time': wall,
+        'source_requests': groups['sources'][0],
+        'source_bytes_sent': groups['sources'][2],
+        'ckan_requests': groups['ckan'][0],
+        'ckan_bytes_received': groups['ckan'][1],
+        'peak_memory': peak,
+    }
+    results.append(result)
+    print('%-16s %-8s %3d %8.2f %8d %10.2f %8d %10.2f %8.1f' % (
+        pipeline, run, code, wall, result['source_requests'], result['source_bytes_sent'] / 2**20,
+        result['ckan_requests'], result['ckan_bytes_received'] / 2**20, peak / 2**20))
+
+sources.stop()
+if args.json:
+    with open(args.json, 'w', encoding='utf-8') as f:
+        json.dump({'scale': args.scale, 'latency': args.latency, 'ckan_latency': args.ckan_latency,
+                   'results': results}, f, indent=1)
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""
+Compares speed of row transform of elektronabijecky (RowTransform) with the
+original prepare_data, which converted date and built IRI for every row.
+
+Cleaned tables (interval and consumption cells, as clean_data returns them)
+are rebuilt from committed backup CSVs, one per month, station and socket.
+Both transforms have to give back exactly the rows of backup files.
+"""
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root + '/elektronabijecky')
+import elektronabijecky
+from sources import STATIONS, SOCKETS, RESOURCE_IRI, evmapy_tables
+
+CONFIG = {
+    'resource_iri': RESOURCE_IRI,
+    'station_dict': STATIONS,
+    'socket_dict': SOCKETS,
+}
+
+def legacy_prepare_data(list_of_rows, station, socket):
+    """prepare_data as it was before RowTransform, rows are rewritten in place"""
+    config = CONFIG
+    index = 0
+    for row in list_of_rows:
+        row[0] = row[0].split(' ')
+        del row[0][2] # Removed dash " - " separator from time
+        date = datetime.strptime(row[0][0], '%d.%m.%Y').strftime('%Y-%m-%d')
+
+        row[0][1] = date + 'T' + row[0][1] + ':00'
+        row[0][2] = date + 'T' + row[0][2] + ':00'
+        del row[0][0]
+        consumption = row[1].split(' ')
+        iri = config['resource_iri'] + config['station_dict'][station] + '/' + config['socket_dict'][socket]
+        list_of_rows[index] = [iri] + row[0] + [consumption[0]] + [consumption[1].upper()]
+        index += 1
+
+    return list_of_rows
+
+def cleaned_tables():
+    """Returns [(cleaned rows, station, socket, expected rows)] rebuilt from backup CSVs"""
+    tables = []
+    for (period, station, socket), rows in sorted(evmapy_tables().items()):
+        iri = RESOURCE_IRI + STATIONS[station] + '/' + SOCKETS[socket]
+        cleaned = []
+        expected = []
+        for start, end, consumption in rows:
+            day = datetime.strptime(start[:10], '%Y-%m-%d').strftime('%d.%m.%Y')
+            cleaned.append([day + ' ' + start[11:16] + ' - ' + end[11:16], consumption + ' kWh'])
+            expected.append((iri, start, end, consumption, 'KWH'))
+        tables.append((cleaned, station, socket, expected))
+    return tables
+
+def measure(func, tables, repeat):
+    best = None
+    for _ in range(repeat):
+        # Legacy transform rewrites its input, every repetition gets fresh copy
+        inputs = [[list(row) for row in table[0]] for table in tables]
+        start = time.perf_counter()
+        for rows, (_, station, socket, _) in zip(inputs, tables):
+            func(rows, station, socket)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+parser = argparse.ArgumentParser(description='Benchmark elektronabijecky.prepare_data row transform')
+parser.add_argument('--scale', action='store', type=int, default=100, help='times the backup tables are repeated')
+parser.add_argument('-r', '--repeat', action='store', type=int, default=5, help='number of repetitions, best is reported')
+args = parser.parse_args()
+
+tables = cleaned_tables()
+for cleaned, station, socket, expected in tables:
+    legacy = [tuple(row) for row in legacy_prepare_data([list(row) for row in cleaned], station, socket)]
+    current = elektronabijecky.RowTransform(CONFIG)(cleaned, station, socket)
+    if legacy != expected or current != expected:
+        sys.exit('Transforms differ from backup rows of station %s socket %s' % (station, socket))
+tables = tables * args.scale
+rows = sum(len(table[0]) for table in tables)
+
+legacy = measure(legacy_prepare_data, tables, args.repeat)
+# Transform is built once per run, the same as in elektronabijecky.run()
+current = measure(elektronabijecky.RowTransform(CONFIG), tables, args.repeat)
+print('%d tables, %d rows' % (len(tables), rows))
+print('%-22s %8.3f s %10.0f rows/s' % ('prepare_data (legacy)', legacy, rows / legacy))
+print('%-22s %8.3f s %10.0f rows/s' % ('RowTransform', current, rows / current))
+print('speedup %.1fx' % (legacy / current))
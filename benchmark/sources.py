@@ -0,0 +1,235 @@
+"""
+Local stand-ins of data sources and CKAN used by benchmarks. Responses are
+rebuilt from committed backup/ files (Evmapy stats pages, export.asp
+sessions) or generated (temp.asp, which has no backup), optionally scaled
+and delayed. Every request is counted with bytes received and sent.
+"""
+import os
+import csv
+import glob
+import json
+import math
+import time
+import threading
+from collections import defaultdict, Counter
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+STATIONS = {'319': 'centrální-parkoviště', '351': 'stará-radnice'}
+SOCKETS = {'343': 'konektor-2-mennekes-22kw', '344': 'zasuvka-230v', '391': 'stojan-1'}
+RESOURCE_IRI = 'https://data.zdarns.cz/zdroj/'
+
+def page_from_rows(rows, padding):
+    """Builds Evmapy stats page with summary table and detail table of given rows"""
+    detail = ['<tr>' + '<td>h%d</td>' % 0 + ''.join('<td>h%d</td>' % i for i in range(1, 10)) + '</tr>',
+              '<tr><td colspan="10">Detail</td></tr>']
+    for index, (start, end, consumption) in enumerate(rows):
+        start = datetime.strptime(start, '%Y-%m-%dT%H:%M:%S')
+        end = datetime.strptime(end, '%Y-%m-%dT%H:%M:%S')
+        interval = start.strftime('%d.%m.%Y %H:%M') + ' - ' + end.strftime('%H:%M')
+        detail.append('<tr><td>%d</td><td>%s</td><td>RFID</td><td><b>%s</b></td><td>%s kWh</td>'
+                      '<td>0</td><td>0</td><td>0 Kč</td><td>-</td><td><a href="#">detail</a></td></tr>'
+                      % (index + 1, interval, index, consumption))
+    detail.append('<tr><td>Celkem</td></tr>')
+    menu = ''.join('<li><a href="/stanice/%d">Stanice %d</a></li>' % (i, i) for i in range(padding))
+    footer = ''.join('<div class="footer-item"><p>Položka %d</p></div>' % i for i in range(padding))
+    return ('<html><head><meta charset="utf-8"><title>Statistiky</title></head><body>'
+            '<ul class="menu">' + menu + '</ul>'
+            '<table class="summary"><tr><td>Celkem</td><td>%d</td></tr></table>' % len(rows) +
+            '<table class="detail">' + ''.join(detail) + '</table>'
+            '<footer>' + footer + '<script>var stats = {};</script></footer></body></html>')
+
+def evmapy_tables():
+    """Returns rows of backup CSVs keyed by (YYYYMM, station, socket)"""
+    station_ids = {name: id for id, name in STATIONS.items()}
+    socket_ids = {name: id for id, name in SOCKETS.items()}
+    tables = defaultdict(list)
+    for filename in sorted(glob.glob(root + '/elektronabijecky/backup/*.csv')):
+        with open(filename, encoding='utf-8') as f:
+            reader = csv.reader(f)
+            next(reader)
+            for iri, start, end, consumption, unit in reader:
+                station, socket = iri[len(RESOURCE_IRI):].split('/')
+                period = start[:4] + start[5:7]
+                tables[period, station_ids[station], socket_ids[socket]].append((start, end, consumption))
+    return tables
+
+def temperature_csv(year, month, scale):
+    """Generates temp.asp export of month, 144 * scale rows a day"""
+    step = timedelta(seconds=600 / scale)
+    time = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    lines = ['Datum;Teplota 1;Teplota 2;']
+    while time < end:
+        hours = time.timestamp() / 3600
+        temp1 = 10 + 10 * math.sin(hours / 24 * 2 * math.pi)
+        # Second sensor has gaps
+        temp2 = '' if time.minute == 0 else '%.1f' % (temp1 - 1.5)
+        lines.append('%s;%.1f;%s;' % (time.strftime('%Y-%m-%d %H:%M:%S'), temp1, temp2))
+        time += step
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+def sessions():
+    """Returns committed session XML files ordered by date"""
+    return sorted(glob.glob(root + '/uredni-deska/backup/*.xml'))
+
+class Sources:
+    """
+        Serves temp.asp, Evmapy login and stats pages, export.asp and CKAN
+        action API on one local port. scale multiplies rows of temperature
+        exports and stats pages, latency (seconds) delays every response of
+        data sources, ckan_latency every CKAN response.
+    """
+
+    FIRST_SESSION_ID = 1000
+
+    def __init__(self, scale=1, latency=0, ckan_latency=0, padding=200):
+        self.scale = scale
+        self.latency = latency
+        self.ckan_latency = ckan_latency
+        self.padding = padding
+        self.tables = evmapy_tables()
+        self.sessions = sessions()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = Counter()
+            self.received = Counter()
+            self.sent = Counter()
+            self.packages = {}
+            self.resources = 0
+
+    def count(self, endpoint, received, sent):
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.received[endpoint] += received
+            self.sent[endpoint] += sent
+
+    def start(self):
+        sources = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request()
+
+            def handle_request(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                url = urlparse(self.path)
+                endpoint, code, content_type, content, headers = sources.respond(
+                    url.path, parse_qs(url.query), body, self.headers)
+                sources.count(endpoint, len(body) + len(self.path), len(content))
+                time.sleep(sources.ckan_latency if endpoint.startswith('ckan') else sources.latency)
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, path, query, body, headers):
+        """Returns endpoint name, status, content type, content and extra headers"""
+        html = 'text/html; charset=utf-8'
+        if path.endswith('/temp.asp'):
+            content = temperature_csv(int(query['R'][0]), int(query['M'][0]), self.scale)
+            return 'temp.asp', 200, 'text/plain', content, []
+        if path.endswith('/users_login.php'):
+            return 'evmapy login', 200, html, b'ok', [('Set-Cookie', 'PHPSESSID=bench; Path=/')]
+        if path.endswith('/muj-ucet'):
+            if 'PHPSESSID=bench' not in (headers.get('Cookie') or ''):
+                return 'evmapy stats', 200, html, b'<form action="users_login.php"></form>', []
+            rows = self.tables.get((query['period'][0], query['station'][0], query['pump'][0]), [])
+            content = page_from_rows(rows * self.scale, self.padding).encode('utf-8')
+            return 'evmapy stats', 200, html, content, []
+        if path.endswith('/export.asp'):
+            index = int(parse_qs(body.decode())['fIDS'][0]) - self.FIRST_SESSION_ID
+            if not 0 <= index < len(self.sessions):
+                return 'export.asp', 200, html, 'Chyba <br>'.encode('utf-8'), []
+            with open(self.sessions[index], 'rb') as f:
+                return 'export.asp', 200, 'text/xml', f.read(), []
+        if '/api/action/' in path:
+            action = path.rsplit('/', 1)[1]
+            code, result = self.ckan(action, self.ckan_data(body, headers.get('Content-Type', '')))
+            content = json.dumps({'success': code == 200, 'result': result}).encode('utf-8')
+            return 'ckan ' + action, code, 'application/json', content, []
+        return 'unknown', 404, 'text/plain', b'Not found', []
+
+    def ckan_data(self, body, content_type):
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/'):
+            message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            data = {}
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename() is None:
+                    data[name] = part.get_payload(decode=True).decode('utf-8')
+            return data
+        return {name: values[0] for name, values in parse_qs(body.decode('utf-8')).items()}
+
+    def ckan(self, action, data):
+        """Minimal in-memory CKAN, returns status code and result"""
+        with self.lock:
+            packages = self.packages
+            if action == 'package_show':
+                package = packages.get(data['id']) or next(
+                    (p for p in packages.values() if p['id'] == data['id']), None)
+                return (200, package) if package else (404, None)
+            if action == 'package_create':
+                package = {'id': 'id-' + data['name'], 'name': data['name'], 'state': 'active', 'resources': []}
+                packages[data['name']] = package
+                return 200, package
+            if action in ('resource_create', 'resource_update', 'resource_patch', 'resource_delete'):
+                for package in packages.values():
+                    if action == 'resource_create' and package['id'] == data.get('package_id'):
+                        self.resources += 1
+                        resource = dict(data, id='resource-%d' % self.resources, package_id=package['id'])
+                        package['resources'].append(resource)
+                        return 200, resource
+                    for resource in package['resources']:
+                        if resource['id'] == data.get('id'):
+                            if action == 'resource_delete':
+                                package['resources'].remove(resource)
+                                return 200, None
+                            resource.update(data)
+                            return 200, resource
+                return 404, None
+            if action == 'datapusher_status':
+                return 200, {'status': 'complete'}
+            # datastore_create, datastore_upsert, datapusher_submit
+            return 200, {}
+
+    def report(self):
+        """Returns (requests, received, sent) of data sources and of CKAN"""
+        with self.lock:
+            groups = {'sources': [0, 0, 0], 'ckan': [0, 0, 0]}
+            for endpoint, count in self.requests.items():
+                group = groups['ckan' if endpoint.startswith('ckan') else 'sources']
+                group[0] += count
+                group[1] += self.received[endpoint]
+                group[2] += self.sent[endpoint]
+            return groups
@@ -0,0 +1,3 @@
+"""
+Code shared by scripts publishing Open Data of Žďár nad Sázavou into CKAN
+"""
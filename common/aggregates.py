@@ -0,0 +1,116 @@
+"""
+Vectorized aggregates of published rows (NumPy) and their partial state,
+which is merged month by month instead of rescanning year files
+"""
+import json
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def available():
+    """Aggregates need NumPy, they are skipped with warning without it"""
+    if numpy is None:
+        logging.warning('numpy is not installed, aggregates are not computed')
+    return numpy is not None
+
+def table(rows):
+    """Returns rows of strings as 2D array, so columns are sliced without Python loop"""
+    return numpy.array(rows, dtype=str).reshape(len(rows), -1)
+
+def encode(values):
+    """Returns distinct values and integer code of every value (dictionary encoding)"""
+    uniques, codes = numpy.unique(numpy.asarray(values), return_inverse=True)
+    return uniques, codes
+
+def days(timestamps):
+    """Returns day numbers (since epoch) of ISO timestamps"""
+    # Casting to 10 characters cuts off time in C, no Python loop over rows
+    return numpy.asarray(timestamps, dtype='U10').astype('datetime64[D]').astype(numpy.int64)
+
+def day_string(day):
+    return str(numpy.datetime64(int(day), 'D'))
+
+def minutes(timestamps):
+    """Returns minutes (since epoch) of ISO timestamps"""
+    return numpy.asarray(timestamps, dtype='U16').astype('datetime64[m]').astype(numpy.int64)
+
+def _groups(keys, size):
+    """Returns order sorting rows by key columns, sorted keys and index of first row of every group"""
+    # lexsort sorts by the last key first
+    order = numpy.lexsort(keys[::-1])
+    keys = [numpy.asarray(key)[order] for key in keys]
+    change = numpy.zeros(size, dtype=bool)
+    change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return order, keys, numpy.flatnonzero(change)
+
+def reduce_groups(keys, values):
+    """
+        Groups rows by key columns (integer arrays of the same length) and
+        returns key columns of groups with count, sum, min and max of values
+        of every group. Groups are sorted by keys.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if len(values) == 0:
+        return [key[:0] for key in keys], numpy.zeros(0, numpy.int64), values, values, values
+    order, keys, starts = _groups(keys, len(values))
+    values = values[order]
+    counts = numpy.diff(numpy.append(starts, len(values)))
+    return ([key[starts] for key in keys], counts, numpy.add.reduceat(values, starts),
+            numpy.minimum.reduceat(values, starts), numpy.maximum.reduceat(values, starts))
+
+def sum_groups(keys, columns):
+    """
+        Groups rows by key columns like reduce_groups and returns key columns
+        of groups with number of rows and sums of every value column
+        (2D array, one row per group).
+    """
+    values = numpy.column_stack([numpy.asarray(column, dtype=numpy.float64) for column in columns])
+    if len(values) == 0:
+        return [key[:0] for key in keys], numpy.zeros(0, numpy.int64), values
+    order, keys, starts = _groups(keys, len(values))
+    counts = numpy.diff(numpy.append(starts, len(values)))
+    return [key[starts] for key in keys], counts, numpy.add.reduceat(values[order], starts, axis=0)
+
+def merge(a, b):
+    """Merges two partial aggregates [count, sum, min, max]"""
+    return [a[0] + b[0], a[1] + b[1], min(a[2], b[2]), max(a[3], b[3])]
+
+def add(a, b):
+    """Merges two partial aggregates made only of counts and sums"""
+    return [x + y for x, y in zip(a, b)]
+
+def rollup(partials, key, merge=merge):
+    """Merges partial aggregates into coarser groups given by key(group)"""
+    result = {}
+    for group, partial in partials.items():
+        coarse = key(group)
+        result[coarse] = merge(result[coarse], partial) if coarse in result else partial
+    return result
+
+def fold(partials, new, merge=merge):
+    """Merges partial aggregates new into partials of the same groups"""
+    for group, partial in new.items():
+        partials[group] = merge(partials[group], partial) if group in partials else partial
+
+def replace(partials, prefix, new):
+    """Replaces partial aggregates of groups starting with prefix by new ones"""
+    for group in [group for group in partials if group.startswith(prefix)]:
+        del partials[group]
+    partials.update(new)
+
+def load(filename):
+    """Returns stored partial aggregates keyed by group, empty if there are none"""
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save(filename, partials):
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(partials, f, sort_keys=True)
@@ -0,0 +1,200 @@
+"""
+On-disk cache of raw HTTP responses of data sources
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import requests
+from requests.structures import CaseInsensitiveDict
+
+class CachedBody:
+    """Cached body used as raw stream of response, file is closed once read to the end"""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        if not chunk:
+            self.file.close()
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+class ResponseCache:
+    """
+        Stores body of responses keyed by endpoint and parameters. Immutable
+        entries (closed months, published sessions) are served without any
+        request, others are revalidated with If-None-Match/If-Modified-Since
+        when source provides ETag/Last-Modified. Entries not used for max_age
+        seconds are removed and least recently used ones are removed when the
+        cache grows over max_size bytes.
+        Bodies are streamed to and from disk, so cached response can be read
+        with iter_lines() without holding whole body in memory.
+        Disabled cache does not read nor store anything.
+    """
+
+    def __init__(self, directory, max_size=500 * 2**20, max_age=365 * 86400, enabled=True):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.enabled = enabled
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+            self.evict()
+
+    def key(self, *parts):
+        """Returns key of request given by method, url and parameters"""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        path = os.path.join(self.directory, key)
+        return path + '.json', path + '.body'
+
+    def _load(self, key):
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            # Mark as recently used for eviction
+            os.utime(body_path)
+        except (OSError, ValueError):
+            return None
+        return meta
+
+    def _response(self, key, meta, body_path=None):
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK (cached)'
+        response.url = meta['url']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = CachedBody(body_path or self._paths(key)[1])
+        return response
+
+    def fresh(self, key):
+        """Returns cached response of immutable entry, None if it must be requested"""
+        if not self.enabled:
+            return None
+        meta = self._load(key)
+        if meta is None or not meta['immutable']:
+            return None
+        logging.debug('Cache hit %s', meta['url'])
+        return self._response(key, meta)
+
+    def validators(self, key):
+        """Returns headers for conditional request of cached entry"""
+        if not self.enabled:
+            return {}
+        meta = self._load(key)
+        headers = {}
+        if meta is not None:
+            if meta['headers'].get('ETag'):
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if meta['headers'].get('Last-Modified'):
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        return headers
+
+    def store(self, key, response, immutable=False, valid=None):
+        """
+            Stores successful response and returns it. If source answered 304
+            Not Modified, cached response is returned instead. Response is
+            stored only if valid(response) is true, so error pages are never
+            served from cache. valid gets response read from body already
+            written to disk, streamed body is not held in memory for it.
+        """
+        if not self.enabled:
+            return response
+        if response.status_code == 304:
+            meta = self._load(key)
+            if meta is not None:
+                logging.debug('Not modified %s', meta['url'])
+                return self._response(key, meta)
+        if response.status_code != 200:
+            return response
+
+        meta = {
+            'url': response.url,
+            'headers': {name: response.headers[name]
+                        for name in ('Content-Type', 'ETag', 'Last-Modified')
+                        if name in response.headers},
+            'immutable': immutable,
+            'stored': time.time(),
+        }
+        meta_path, body_path = self._paths(key)
+        try:
+            # Body goes first, meta file makes entry visible
+            with open(body_path + '.tmp', 'wb') as f:
+                for chunk in response.iter_content(1 << 16):
+                    f.write(chunk)
+            if valid is not None:
+                check = self._response(key, meta, body_path + '.tmp')
+                try:
+                    accepted = valid(check)
+                finally:
+                    check.close()
+                if not accepted:
+                    logging.debug('Not caching invalid response of %s', meta['url'])
+                    # Body stays readable through open file after it is removed
+                    rejected = self._response(key, meta, body_path + '.tmp')
+                    os.remove(body_path + '.tmp')
+                    return rejected
+            os.replace(body_path + '.tmp', body_path)
+            with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(meta_path + '.tmp', meta_path)
+        except OSError as e:
+            logging.warning('Could not store response into cache: %s', e)
+            return response
+        # Body of response was consumed while storing, it is read from cache now
+        return self._response(key, meta)
+
+    def fetch(self, session, method, url, immutable=False, valid=None, **kwargs):
+        """
+            Requests url through cache. Response is stored only if valid(response)
+            is true, so error pages are never served from cache.
+        """
+        key = self.key(method, url, kwargs.get('params'), kwargs.get('data'))
+        response = self.fresh(key)
+        if response is not None:
+            return response
+
+        headers = dict(kwargs.pop('headers', None) or {}, **self.validators(key))
+        response = session.request(method, url, headers=headers, **kwargs)
+        return self.store(key, response, immutable, valid)
+
+    def evict(self):
+        """Removes expired entries and least recently used ones above size limit"""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.body'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-len('.body')]))
+
+        entries.sort()
+        total = sum(size for mtime, size, key in entries)
+        for mtime, size, key in entries:
+            if now - mtime <= self.max_age and total <= self.max_size:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+def from_config(location, config, enabled=True):
+    """Creates cache configured by cache_* options of script config"""
+    return ResponseCache(os.path.join(location, config.get('cache_dir', '../.cache')),
+                         config.get('cache_max_size', 500) * 2**20,
+                         config.get('cache_max_age', 365) * 86400,
+                         enabled)
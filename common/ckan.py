@@ -0,0 +1,296 @@
+"""
+Helpers for CKAN action API shared by scripts
+"""
+import os
+import json
+import time
+import logging
+import threading
+import requests
+
+from common import connections
+from common.pool import ordered_map
+from common.publish import atomic_write
+from common.metrics import NULL
+from common.upload import MultipartUpload
+
+# Actions which can be safely repeated after timeout or server error
+IDEMPOTENT_ACTIONS = {'package_show', 'resource_update', 'resource_patch', 'datastore_create',
+                      'datastore_upsert', 'datapusher_status'}
+
+class CkanClient:
+    """
+        CKAN action API client shared by scripts. Datasets are looked up by
+        name once per run and their resources are indexed by name. Known IDs
+        and hashes are also kept in persisted catalog, so next runs don't have
+        to ask CKAN at all. Catalog is updated from responses of every
+        create/update call, entry that turns out to be stale (dataset or
+        resource deleted in CKAN) is dropped and looked up again.
+        Requests go through connection pool shared by the process and are
+        counted by metrics of the script. Failed requests are retried by the
+        session, non-idempotent actions only when CKAN surely didn't get them.
+        Files are streamed from disk, files of at least gzip_min_size bytes
+        are uploaded gzipped (None disables it).
+    """
+
+    def __init__(self, url_api, apikey, catalog=None, metrics=NULL, gzip_min_size=None):
+        self.url_api = url_api
+        self.headers = {'Authorization': apikey}
+        self.metrics = metrics
+        self.session = metrics.instrument(connections.session())
+        self.gzip_min_size = gzip_min_size
+        self.catalog = catalog
+        # Names of datasets looked up or created by this run
+        self.verified = set()
+        self.lock = threading.Lock()
+        self.packages = {}
+        if catalog:
+            try:
+                with open(catalog, encoding='utf-8') as f:
+                    self.packages = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def save(self):
+        if self.catalog:
+            data = json.dumps(self.packages, indent=1, sort_keys=True).encode('utf-8')
+            atomic_write(self.catalog, lambda f: f.write(data))
+
+    def post_file(self, action, data, filename, idempotent):
+        """Posts form data with file streamed from disk, logs throughput of upload"""
+        size = os.path.getsize(filename)
+        gzip_file = self.gzip_min_size is not None and size >= self.gzip_min_size
+        with MultipartUpload(data, 'upload', filename, gzip_file) as body:
+            headers = dict(self.headers, **{'Content-Type': body.content_type})
+            start = time.monotonic()
+            r = self.session.post(self.url_api + action, data=body, headers=headers, idempotent=idempotent)
+            elapsed = max(time.monotonic() - start, 1e-6)
+        logging.info('Uploaded %s (%.2f MB%s) in %.1f s, %.2f MB/s', os.path.basename(filename), len(body) / 2**20,
+                     ', gzipped from %.2f MB' % (size / 2**20) if gzip_file else '', elapsed,
+                     len(body) / 2**20 / elapsed)
+        self.metrics.observe('upload_seconds', elapsed, action=action)
+        self.metrics.count('upload_file_bytes_total', size, action=action)
+        return r
+
+    def action(self, action, data, filename=None):
+        """Calls CKAN action, returns its result or None on error"""
+        idempotent = action in IDEMPOTENT_ACTIONS
+        try:
+            if filename:
+                r = self.post_file(action, data, filename, idempotent)
+            else:
+                r = self.session.post(self.url_api + action, data=data, headers=self.headers,
+                                      idempotent=idempotent)
+            if action == 'package_show' and r.status_code == 404:
+                return None
+            r.raise_for_status()
+            return r.json()['result']
+        except requests.exceptions.RequestException as e:
+            if e.response is not None:
+                logging.error(e.response.text)
+            logging.error(e)
+        except (ValueError, KeyError) as e:
+            logging.error('Invalid response of %s: %s', action, e)
+        return None
+
+    def _entry(self, package):
+        return {
+            'id': package['id'],
+            'name': package['name'],
+            'resources': {resource['name']: {'id': resource['id'], 'hash': resource.get('hash', '')}
+                          for resource in package.get('resources', [])},
+        }
+
+    def package(self, name, fresh=False):
+        """
+            Returns dataset with resources indexed by name, None if it doesn't
+            exist or is deleted. With fresh it is always looked up in CKAN.
+        """
+        with self.lock:
+            if name in self.packages and not fresh:
+                return self.packages[name]
+        result = self.action('package_show', {'id': name})
+        if result is None or result['state'] == 'deleted':
+            logging.info('Dataset %s does not exists', name)
+            return None
+        with self.lock:
+            self.packages[name] = self._entry(result)
+            self.verified.add(name)
+            self.save()
+            return self.packages[name]
+
+    def create_package(self, data):
+        result = self.action('package_create', data)
+        if result is None:
+            return None
+        with self.lock:
+            self.packages[result['name']] = self._entry(result)
+            self.verified.add(result['name'])
+            self.save()
+            return self.packages[result['name']]
+
+    def forget(self, name):
+        with self.lock:
+            self.packages.pop(name, None)
+            self.save()
+
+    def resource(self, package, name):
+        """Returns {'id', 'hash'} of resource of dataset by name, None if there is none"""
+        return package['resources'].get(name)
+
+    def _remember(self, package, resource):
+        with self.lock:
+            package['resources'][resource['name']] = {'id': resource['id'], 'hash': resource.get('hash', '')}
+            self.save()
+
+    def _upload(self, action, package, data, filename):
+        result = self.action(action, data, filename)
+        if result is None and package['name'] not in self.verified:
+            # Catalog may be stale, look dataset up again and retry once
+            logging.warning('Catalog entry of %s may be stale, refreshing it', package['name'])
+            self.forget(package['name'])
+            fresh = self.package(package['name'])
+            if fresh is None:
+                return None
+            package = fresh
+            data = dict(data, package_id=fresh['id'])
+            resource = fresh['resources'].get(data['name'])
+            if resource:
+                action, data['id'] = 'resource_update', resource['id']
+            else:
+                action = 'resource_create'
+                data.pop('id', None)
+            result = self.action(action, data, filename)
+        if result is not None:
+            self._remember(package, result)
+        return result
+
+    def create_resource(self, package, data, filename):
+        """Uploads file as new resource of dataset, returns the resource or None on error"""
+        return self._upload('resource_create', package, data, filename)
+
+    def update_resource(self, package, data, filename):
+        """Uploads file into existing resource (data['id']), returns the resource or None on error"""
+        return self._upload('resource_update', package, data, filename)
+
+    def patch_resource(self, data, filename):
+        """Replaces file of resource keeping its other fields, returns False on error"""
+        result = self.action('resource_patch', data, filename)
+        if result is None:
+            return False
+        with self.lock:
+            for package in self.packages.values():
+                if package['id'] == result['package_id']:
+                    package['resources'][result['name']] = {'id': result['id'], 'hash': result.get('hash', '')}
+            self.save()
+        return True
+
+    def delete_resource(self, resource_id):
+        if self.action('resource_delete', {'id': resource_id}) is None:
+            return False
+        with self.lock:
+            for package in self.packages.values():
+                package['resources'] = {name: resource for name, resource in package['resources'].items()
+                                        if resource['id'] != resource_id}
+            self.save()
+        return True
+
+def from_config(location, config, metrics=NULL):
+    """Returns client configured by url_api, apikey, catalog and upload_gzip_min_size (MB) of script config"""
+    gzip_min_size = config.get('upload_gzip_min_size')
+    return CkanClient(config['url_api'], config['apikey'],
+                      location + '/' + config.get('catalog', 'backup/.catalog.json'), metrics,
+                      gzip_min_size * 2**20 if gzip_min_size is not None else None)
+
+def datastore_upsert(url_api, apikey, resource_id, fields, primary_key, rows, chunk_size=1000, session=None):
+    """
+        Pushes rows into DataStore table of resource. Table is declared with
+        given fields and primary key first (existing table is kept), rows are
+        then upserted in chunks, so rerun of a month replaces its rows instead
+        of duplicating them. Returns False if any request failed.
+    """
+    headers = {'Authorization': apikey, 'Content-Type': 'application/json'}
+    ids = [field['id'] for field in fields]
+
+    session = session or connections.shared()
+
+    def post(action, data):
+        try:
+            r = session.post(url_api + action, data=json.dumps(data), headers=headers,
+                             idempotent=action in IDEMPOTENT_ACTIONS)
+            r.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logging.error(e)
+            logging.error('DataStore request %s failed', action)
+            return False
+        return True
+
+    data = {
+        'resource_id': resource_id,
+        'fields': fields,
+        'primary_key': primary_key,
+        'force': True,  # Resources with uploaded file are read-only otherwise
+    }
+    if not post('datastore_create', data):
+        return False
+
+    count = 0
+    records = []
+    for row in rows:
+        # Empty cell can't be stored into numeric column
+        records.append({id: value if value != '' else None for id, value in zip(ids, row)})
+        if len(records) == chunk_size:
+            if not post('datastore_upsert', {'resource_id': resource_id, 'records': records, 'method': 'upsert', 'force': True}):
+                return False
+            count += len(records)
+            records = []
+    if records:
+        if not post('datastore_upsert', {'resource_id': resource_id, 'records': records, 'method': 'upsert', 'force': True}):
+            return False
+        count += len(records)
+
+    logging.info('Upserted %s rows into DataStore of resource %s', count, resource_id)
+    return True
+
+def datapusher_push(url_api, apikey, resource_ids, workers=4, timeout=600, delay=1, max_delay=30, session=None):
+    """
+        Submits resources to datapusher at once and waits until they are
+        ingested into DataStore. Status of every resource is polled with
+        exponential backoff up to max_delay seconds. Ingest latency of every
+        resource is logged. Returns False if any of them failed or timed out.
+    """
+    headers = {'Authorization': apikey}
+    session = session or connections.shared()
+
+    def post(action, resource_id):
+        r = session.post(url_api + action, json={'resource_id': resource_id}, headers=headers,
+                         idempotent=action in IDEMPOTENT_ACTIONS)
+        r.raise_for_status()
+        return r.json()['result']
+
+    def push(resource_id):
+        start = time.monotonic()
+        try:
+            post('datapusher_submit', resource_id)
+            wait = delay
+            while True:
+                time.sleep(wait)
+                status = post('datapusher_status', resource_id).get('status')
+                latency = time.monotonic() - start
+                if status == 'complete':
+                    logging.info('Resource %s ingested into DataStore in %.1f s', resource_id, latency)
+                    return True
+                if status == 'error':
+                    logging.error('Datapusher failed to ingest resource %s after %.1f s', resource_id, latency)
+                    return False
+                if latency > timeout:
+                    logging.error('Datapusher did not ingest resource %s in %s s', resource_id, timeout)
+                    return False
+                wait = min(wait * 2, max_delay)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            logging.error(e)
+            logging.error('Datapusher request for resource %s failed', resource_id)
+            return False
+
+    resource_ids = sorted(resource_ids)
+    return all(list(ordered_map(push, resource_ids, max(1, min(workers, len(resource_ids))))))
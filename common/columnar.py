@@ -0,0 +1,77 @@
+"""
+Typed columnar copy of yearly CSV files for analysts, Parquet if pyarrow
+is installed, gzip-compressed CSV otherwise
+"""
+import os
+import csv
+import gzip
+import logging
+from datetime import datetime
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+def read_rows(filename, table_head):
+    """Yields rows of CSV file written by script, without table head"""
+    with open(filename, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if row == table_head:
+                continue
+            yield row
+
+def column_array(values, field_type):
+    """Converts column of strings into typed arrow array"""
+    if field_type == 'timestamp':
+        return pyarrow.array([datetime.fromisoformat(value) if value else None for value in values],
+                             pyarrow.timestamp('s'))
+    if field_type == 'numeric':
+        return pyarrow.array([float(value) if value else None for value in values], pyarrow.float64())
+    # IRIs, sensor names and units repeat on every row
+    return pyarrow.array(values, pyarrow.string()).dictionary_encode()
+
+def write_parquet(filename, rows, fields, compression):
+    columns = list(zip(*rows)) or [()] * len(fields)
+    arrays = [column_array(list(values), field['type']) for values, field in zip(columns, fields)]
+    table = pyarrow.Table.from_arrays(arrays, names=[field['id'] for field in fields])
+    pyarrow.parquet.write_table(table, filename, compression=compression)
+
+def write_csv_gz(filename, rows, fields):
+    with gzip.open(filename, 'wt', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow([field['id'] for field in fields])
+        writer.writerows(rows)
+
+def write_columnar(csv_filename, table_head, fields, file_format='parquet', compression='zstd', output=None,
+                   target=None):
+    """
+        Writes typed copy of yearly CSV file next to it (or next to output if
+        CSV file is temporary one), columns are named and typed by DataStore
+        fields of script (timestamp, numeric, text). With target the copy is
+        written into file returned by target(name), e.g. temporary file of
+        transaction, instead of being renamed over name.
+        Returns name of written file and its CKAN format.
+    """
+    if file_format == 'parquet' and pyarrow is None:
+        logging.warning('pyarrow is not installed, writing gzip-compressed CSV instead of Parquet')
+        file_format = 'csv.gz'
+
+    base = os.path.splitext(output or csv_filename)[0]
+    rows = list(read_rows(csv_filename, table_head))
+    if file_format == 'parquet':
+        filename = base + '.parquet'
+        resource_format = 'PARQUET'
+    else:
+        filename = base + '.csv.gz'
+        resource_format = 'CSV'
+    path = target(filename) if target else filename + '.tmp'
+    if file_format == 'parquet':
+        write_parquet(path, rows, fields, compression)
+    else:
+        write_csv_gz(path, rows, fields)
+    if not target:
+        os.replace(path, filename)
+    logging.info('Written %s rows into %s', len(rows), filename)
+    return filename, resource_format
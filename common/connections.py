@@ -0,0 +1,259 @@
+"""
+HTTP connection pools shared by all pipelines running in one process,
+requests to every host are rate limited and failed ones are retried
+"""
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+import urllib3
+
+# Connections kept per host, enough for workers of all pipelines
+POOL_MAXSIZE = 16
+
+# Failed request is repeated at most RETRIES times, n-th retry waits random
+# time up to BACKOFF * 2**n seconds (full jitter), but at most MAX_BACKOFF
+RETRIES = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 60
+
+# Connect and read timeout, request without timeout may hang forever
+TIMEOUT = (10, 600)
+
+# Server asks us to slow down by these, request is repeated even if it is not idempotent
+THROTTLE_STATUSES = {429, 503}
+# Transient errors, only idempotent requests are repeated after them
+RETRY_STATUSES = THROTTLE_STATUSES | {500, 502, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+# Throttled host is never limited below this rate (requests per second)
+MIN_RATE = 0.1
+
+_adapter = None
+_shared = None
+_limiters = {}
+# Reentrant, shared session is created while holding it
+_lock = threading.RLock()
+
+class HostLimiter:
+    """
+        Limits requests to one host by token bucket of rate requests per second
+        (no limit if rate is None) and by number of requests in flight.
+        Throttled response halves both limits and pauses the host for time
+        given by Retry-After, every successful response lets them grow back
+        (additive increase, multiplicative decrease), so host is queried as
+        fast as it allows. Limiter is shared by all sessions of the process.
+    """
+
+    def __init__(self, host, rate=None, concurrency=POOL_MAXSIZE):
+        self.host = host
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.max_concurrency = concurrency
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate:
+            # Bucket holds at most one second of requests
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Waits until request can be sent, returns time it was sent at"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.resume_at:
+                    timeout = self.resume_at - now
+                elif self.in_flight >= self.concurrency:
+                    timeout = None
+                elif self.rate and self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    if self.rate:
+                        self.tokens -= 1
+                    self.in_flight += 1
+                    return now
+                self.condition.wait(timeout)
+
+    def release(self, started, success, throttled=False, delay=0):
+        """
+            Records result of request sent at started. Limits are decreased
+            only once for requests which were already in flight when the host
+            throttled us, they are answered by the same overloaded host.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.successes = 0
+                self.resume_at = max(self.resume_at, now + delay)
+                if started > self.decreased_at:
+                    self.decreased_at = now
+                    self.concurrency = max(1, self.concurrency // 2)
+                    if self.rate:
+                        self._refill(now)
+                        self.rate = max(MIN_RATE, self.rate / 2)
+                    logging.warning('%s is throttling requests, limited to %s at once and %s per second',
+                                    self.host, self.concurrency, self.rate or 'unlimited')
+            elif success:
+                self.successes += 1
+                if self.successes >= self.concurrency:
+                    self.successes = 0
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    if self.rate:
+                        self._refill(now)
+                        self.rate = min(self.max_rate, self.rate + 1)
+            self.condition.notify_all()
+
+def limiter(host, rate=None):
+    """Returns limiter of host, rate is set by the first session configuring it"""
+    with _lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host, rate)
+        elif rate and not _limiters[host].max_rate:
+            _limiters[host].max_rate = _limiters[host].rate = rate
+        return _limiters[host]
+
+def backoff(attempt):
+    """Returns random delay before retry number attempt (counted from 0)"""
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** attempt))
+
+def retry_after(response):
+    """Returns delay in seconds requested by Retry-After header, 0 if there is none"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return 0
+    try:
+        return min(MAX_BACKOFF, max(0.0, float(value)))
+    except ValueError:
+        pass
+    try:
+        return min(MAX_BACKOFF, max(0.0, parsedate_to_datetime(value).timestamp() - time.time()))
+    except (TypeError, ValueError):
+        return 0
+
+def not_sent(error):
+    """Returns True if request surely did not reach the server, so it can be repeated"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+def resendable(request):
+    """Body read from file or generator can't be sent twice, unless it says it can (MultipartUpload)"""
+    return (request.body is None or isinstance(request.body, (bytes, str)) or
+            getattr(request.body, 'resendable', False))
+
+class Session(requests.Session):
+    """
+        Session using shared connection pools and limiters of hosts. Failed
+        requests are repeated with jittered exponential backoff: connection
+        errors and 5xx responses of idempotent requests, throttled responses
+        (429, 503 or ones recognized by throttled(response)) and requests that
+        never reached the server of any method. POST is not idempotent, unless
+        request is made with idempotent=True. Exception or response of the last
+        attempt is passed to the caller.
+    """
+
+    def __init__(self, retries=RETRIES, rate=None, throttled=None):
+        super().__init__()
+        self.retries = retries
+        self.rate = rate
+        self.throttled = throttled
+        # idempotent argument of request() for send() called by it in the same thread
+        self.local = threading.local()
+        pool = adapter()
+        self.mount('https://', pool)
+        self.mount('http://', pool)
+
+    def request(self, method, url, *args, idempotent=None, **kwargs):
+        self.local.idempotent = idempotent
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            self.local.idempotent = None
+
+    def send(self, request, **kwargs):
+        # Slot of host is held only for one response, redirects are resolved after it is released
+        allow_redirects = kwargs.pop('allow_redirects', True)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = TIMEOUT
+        idempotent = getattr(self.local, 'idempotent', None)
+        if idempotent is None:
+            idempotent = request.method in IDEMPOTENT_METHODS
+        host = urlparse(request.url).hostname
+        limit = limiter(host, self.rate)
+        retries = self.retries if resendable(request) else 0
+
+        attempt = 0
+        while True:
+            started = limit.acquire()
+            try:
+                response = super().send(request, allow_redirects=False, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                limit.release(started, False)
+                if attempt >= retries or not (idempotent or not_sent(e)):
+                    raise
+                delay = backoff(attempt)
+                logging.warning('%s failed: %s, retrying in %.1f s', host, e, delay)
+            except BaseException:
+                limit.release(started, False)
+                raise
+            else:
+                throttled = (response.status_code in THROTTLE_STATUSES or
+                             (self.throttled is not None and self.throttled(response)))
+                delay = max(backoff(attempt), retry_after(response)) if throttled else backoff(attempt)
+                limit.release(started, response.status_code < 500 and not throttled, throttled, delay)
+                if attempt >= retries or not (throttled or idempotent and response.status_code in RETRY_STATUSES):
+                    break
+                logging.warning('%s answered %s, retrying in %.1f s', host,
+                                'too many attempts' if response.status_code < 400 else response.status_code, delay)
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+        if allow_redirects:
+            history = list(self.resolve_redirects(response, request, **kwargs))
+            if history:
+                history.insert(0, response)
+                response = history.pop()
+                response.history = history
+        return response
+
+def adapter():
+    """Returns process-wide adapter holding connection pools"""
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            _adapter = requests.adapters.HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+    return _adapter
+
+def session(retries=RETRIES, rate=None, throttled=None):
+    """
+        Returns new session using shared connection pools and host limiters,
+        so its cookies are kept separately, but connections are reused across
+        sessions. Closing the session only drops idle connections, pools are
+        recreated on next request. rate limits requests per second of every
+        host, throttled(response) recognizes throttling answered with 200.
+    """
+    return Session(retries, rate, throttled)
+
+def shared():
+    """Returns process-wide session for stateless requests (CKAN API)"""
+    global _shared
+    with _lock:
+        if _shared is None:
+            _shared = Session()
+    return _shared
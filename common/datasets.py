@@ -0,0 +1,195 @@
+"""
+Publishing of year files and files derived from them into yearly CKAN
+datasets, shared by scripts
+"""
+import os
+import logging
+
+from common.manifest import file_sha256
+from common.columnar import write_columnar
+from common.ckan import datastore_upsert
+from common.metrics import NULL
+
+class Publisher:
+    """
+        Uploads files into resources of datasets named by package and
+        package_name of script config. Unchanged files (by manifest) are not
+        uploaded again. With transaction every upload is recorded in it, so
+        it is committed or rolled back together with the uploaded file.
+    """
+
+    def __init__(self, config, ckan, manifest, transaction=None, metrics=NULL):
+        self.config = config
+        self.ckan = ckan
+        self.manifest = manifest
+        self.transaction = transaction
+        self.metrics = metrics
+
+    def package(self, name, title):
+        """Returns dataset by name, creates it if it does not exist, None on error"""
+        package = self.ckan.package(name)
+
+        # dataset does not exists or is deleted, create one
+        if package is None:
+            logging.info('Creating dataset %s', name)
+            package = self.ckan.create_package({
+                'name': name,
+                'title': title,
+                'private': False,
+                'url': 'upload',  # Needed to pass validation,
+                'owner_org': self.config['owner_org']
+            })
+            if package is None:
+                logging.error('Couldn\'t create dataset %s', name)
+        return package
+
+    def upload(self, package, name, filename, file_format, stage, path=None):
+        """
+            Uploads file into resource of package by name, path is temporary
+            file with its new content. Returns ID of resource, '' if file is
+            unchanged and None on error.
+        """
+        path = path or filename
+        resource = self.ckan.resource(package, name)
+
+        sha256 = file_sha256(path)
+        data = {
+            'package_id': package['id'],
+            'name': name,
+            'format': file_format,
+            'url': 'upload',  # Needed to pass validation
+            'hash': sha256,
+        }
+        if resource is None:
+            logging.info('Creating "%s" resource', name)
+            resource = self.ckan.create_resource(package, data, path)
+            if resource is None:
+                return None
+            resource_id = resource['id']
+            created = True
+        elif self.manifest.unchanged(filename, sha256, resource['id'], resource['hash']):
+            logging.info('%s is unchanged, skipping upload', filename)
+            self.metrics.count('uploads_skipped_total', stage=stage)
+            return ''
+        else:
+            logging.info('Updating "%s" resource', name)
+            resource_id = data['id'] = resource['id']
+            if self.ckan.update_resource(package, data, path) is None:
+                return None
+            created = False
+        if self.transaction is not None:
+            self.transaction.uploaded(filename, resource_id, created=created)
+        self.metrics.count('uploads_total', stage=stage)
+
+        self.manifest.record(filename, sha256, resource_id)
+        return resource_id
+
+    def publish_columnar(self, package, year, filename, path):
+        """
+            Writes typed columnar copy of year file from its new content (path)
+            and uploads it as second resource of package. Returns ID of
+            resource, '' if it is unchanged and None on error.
+        """
+        columnar = self.config['columnar']
+        transaction = self.transaction
+        columnar_filename, file_format = write_columnar(path, self.config['table_head'],
+                                                        self.config['datastore']['fields'],
+                                                        columnar.get('format', 'parquet'),
+                                                        columnar.get('compression', 'zstd'), filename,
+                                                        lambda name: transaction.path(name, truncate=True))
+        # Suffix is taken from basename, directories of year file may contain dots
+        suffix = os.path.basename(columnar_filename).split('.', 1)[1]
+        name = self.config['package_name'] + str(year) + ' (' + suffix + ')'
+        return self.upload(package, name, columnar_filename, file_format, 'columnar',
+                           transaction.current(columnar_filename))
+
+    def publish_year(self, year, storage, publish, derived=()):
+        """
+            Assembles year file from its partitions and uploads it together
+            with its columnar copy, runs in worker thread. Rows of months
+            written by this run are upserted into DataStore from partitions,
+            publish is 'file', 'datastore' or 'both'. Derived are (stage, name,
+            filename, write) of small files of year written by write(path),
+            they are uploaded as next resources. Returns resources with
+            uploaded file, None on error.
+        """
+        filename = storage.filename
+        pushed = set()
+
+        # Year file is assembled from partitions without processing them again
+        with self.metrics.stage('assemble'):
+            path = storage.assemble()
+
+        # Dataset is looked up in CKAN only once per run
+        package = self.package(self.config['package'] + str(year), self.config['package_name'] + str(year))
+        if package is None:
+            return None
+
+        name = self.config['package_name'] + str(year)
+        resource = self.ckan.resource(package, name)
+        if resource is not None and publish == 'datastore':
+            # Only rows are upserted into existing resource
+            resource_id = resource['id']
+        else:
+            with self.metrics.stage('upload'):
+                resource_id = self.upload(package, name, filename, os.path.splitext(filename)[1][1:].upper(),
+                                          'upload', path)
+            if resource_id is None:
+                return None
+            # Upserted resource is not pushed, datapusher would recreate its table from the file
+            if resource_id and publish == 'file':
+                pushed.add(resource_id)
+            resource_id = resource_id or resource['id']
+
+        if publish != 'file' and storage.written_rows():
+            datastore = self.config['datastore']
+            # Rows are streamed from partitions, they are not kept in memory for whole run
+            rows = storage.read(storage.written)
+            with self.metrics.stage('datastore'):
+                upserted = datastore_upsert(self.config['url_api'], self.config['apikey'], resource_id,
+                                            datastore['fields'], datastore['primary_key'], rows,
+                                            datastore.get('chunk_size', 1000), self.ckan.session)
+            if not upserted:
+                return None
+
+        if self.config.get('columnar', {}).get('enabled'):
+            with self.metrics.stage('columnar'):
+                if self.publish_columnar(package, year, filename, path) is None:
+                    return None
+
+        for stage, name, derived_filename, write in derived:
+            with self.metrics.stage(stage):
+                derived_path = self.transaction.path(derived_filename, truncate=True)
+                write(derived_path)
+                resource_id = self.upload(package, name, derived_filename, 'CSV', stage, derived_path)
+            if resource_id is None:
+                return None
+            if resource_id:
+                pushed.add(resource_id)
+
+        return pushed
+
+    def restore(self, resource_id, filename):
+        """
+            Re-sends original file into resource uploaded by failed run,
+            resource created by failed run (filename is None) is deleted.
+        """
+        if filename is None:
+            logging.info('Deleting resource %s', resource_id)
+            return self.ckan.delete_resource(resource_id)
+
+        logging.info('Restoring resource %s from %s', resource_id, filename)
+        sha256 = file_sha256(filename)
+        data = {
+            'id': resource_id,
+            'url': 'upload',  # Needed to pass validation
+            'hash': sha256,
+        }
+        if not self.ckan.patch_resource(data, filename):
+            return False
+        self.manifest.record(filename, sha256, resource_id)
+        return True
+
+    def rollback(self):
+        """Rolls back files and uploads of transaction, returns False if some resource wasn't restored"""
+        return self.transaction.rollback(self.restore)
@@ -0,0 +1,55 @@
+"""
+Local manifest of SHA-256 hashes of files uploaded into CKAN
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+
+def file_sha256(filename):
+    """Returns hex SHA-256 of file content"""
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class Manifest:
+    """
+        Remembers hash of every file uploaded to CKAN resource. Hash is also
+        sent as `hash` field of resource, so file is considered unchanged if
+        it matches hash stored in CKAN, or (if CKAN has none) hash uploaded last
+        time into the same resource.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def key(self, filename):
+        return os.path.relpath(filename, os.path.dirname(self.path))
+
+    def unchanged(self, filename, sha256, resource_id, resource_hash=''):
+        """True if file with given hash doesn't need to be uploaded into resource"""
+        if resource_hash:
+            return resource_hash == sha256
+        entry = self.entries.get(self.key(filename), {})
+        return entry.get('sha256') == sha256 and entry.get('resource_id') == resource_id
+
+    def record(self, filename, sha256, resource_id):
+        """Stores hash of uploaded file, may be called from worker threads"""
+        with self.lock:
+            self.entries[self.key(filename)] = {'sha256': sha256, 'resource_id': resource_id}
+            tmp = self.path + '.tmp'
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(self.entries, f, indent=1, sort_keys=True)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logging.warning('Could not save manifest %s: %s', self.path, e)
@@ -0,0 +1,185 @@
+"""
+Per-stage timing and counters of script run, written at the end of run as
+Prometheus textfile (for node_exporter textfile collector) and JSON summary
+"""
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from common.publish import atomic_write
+
+# Upper bounds of latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+PREFIX = 'opendata_'
+
+class Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe('stage_seconds', time.perf_counter() - self.start, stage=self.stage)
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+def key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+def labels_text(labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels)
+
+class Metrics:
+    """
+        Collects counters and latency histograms of one pipeline. Counters
+        and histograms are keyed by name and labels, every metric gets
+        pipeline label. Safe to use from worker threads.
+    """
+
+    enabled = True
+
+    def __init__(self, pipeline, directory):
+        self.pipeline = pipeline
+        self.directory = directory
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = defaultdict(Histogram)
+
+    def stage(self, name):
+        """Returns context manager measuring duration of stage"""
+        return Timer(self, name)
+
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            self.histograms[key(name, labels)].observe(value)
+
+    def response_hook(self, response, *args, **kwargs):
+        """requests hook counting HTTP statuses and transferred bytes by host"""
+        host = urlparse(response.url).hostname
+        self.count('http_responses_total', host=host, status=response.status_code)
+        length = response.headers.get('Content-Length')
+        if length is None and not kwargs.get('stream'):
+            # Body of non-streamed response is read right after hooks anyway
+            length = len(response.content)
+        self.count('http_downloaded_bytes_total', int(length or 0), host=host)
+        self.count('http_uploaded_bytes_total', int(response.request.headers.get('Content-Length') or 0), host=host)
+
+    def instrument(self, session):
+        """Adds counting of HTTP responses to session, returns the session"""
+        session.hooks['response'].append(self.response_hook)
+        return session
+
+    def prometheus(self):
+        lines = []
+        pipeline = (('pipeline', self.pipeline),)
+        for name, value in sorted(self.gauges.items()):
+            lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+            lines.append('%s%s{%s} %s' % (PREFIX, name, labels_text(pipeline), repr(value)))
+        for name in sorted({name for name, labels in self.counters}):
+            lines.append('# TYPE %s%s counter' % (PREFIX, name))
+            for (counter, labels), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append('%s%s{%s} %s' % (PREFIX, name, labels_text(pipeline + labels), repr(value)))
+        for name in sorted({name for name, labels in self.histograms}):
+            lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+            for (histogram, labels), value in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if histogram != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, value.buckets):
+                    cumulative += count
+                    lines.append('%s%s_bucket{%s} %s' % (PREFIX, name, labels_text(pipeline + labels + (('le', bound),)),
+                                                          cumulative))
+                lines.append('%s%s_bucket{%s} %s' % (PREFIX, name, labels_text(pipeline + labels + (('le', '+Inf'),)),
+                                                      value.count))
+                lines.append('%s%s_sum{%s} %s' % (PREFIX, name, labels_text(pipeline + labels), repr(value.sum)))
+                lines.append('%s%s_count{%s} %s' % (PREFIX, name, labels_text(pipeline + labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        return {
+            'pipeline': self.pipeline,
+            'run': self.gauges,
+            'counters': [dict(labels, name=name, value=value)
+                         for (name, labels), value in sorted(self.counters.items())],
+            'histograms': [dict(labels, name=name, count=value.count, sum=value.sum, max=value.max)
+                           for (name, labels), value in sorted(self.histograms.items(), key=lambda item: item[0])],
+        }
+
+    def finish(self, exit_code):
+        """Records result of run and writes Prometheus textfile and JSON summary"""
+        end = time.time()
+        with self.lock:
+            self.gauges['run_duration_seconds'] = end - self.start
+            self.gauges['run_exit_code'] = exit_code
+            self.gauges['run_finished_timestamp_seconds'] = end
+            text = self.prometheus().encode('utf-8')
+            summary = json.dumps(self.summary(), indent=1).encode('utf-8')
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, self.pipeline)
+        atomic_write(filename + '.prom', lambda f: f.write(text))
+        atomic_write(filename + '.json', lambda f: f.write(summary))
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class NullMetrics:
+    """Disabled metrics, every call returns immediately"""
+
+    enabled = False
+    timer = NullTimer()
+
+    def stage(self, name):
+        return self.timer
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def instrument(self, session):
+        return session
+
+    def finish(self, exit_code):
+        pass
+
+NULL = NullMetrics()
+
+def from_config(pipeline, location, config):
+    """Returns metrics written into metrics_dir of script config, disabled if it is not set"""
+    if not config.get('metrics_dir'):
+        return NULL
+    return Metrics(pipeline, os.path.join(location, config['metrics_dir']))
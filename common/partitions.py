@@ -0,0 +1,191 @@
+"""
+Year files stored as month partitions, so import of a month replaces its
+rows instead of appending them again
+"""
+import io
+import os
+import csv
+import json
+import shutil
+import logging
+
+from common.manifest import file_sha256
+
+MANIFEST = 'manifest.json'
+
+def track(entry, row, start, end):
+    """Counts row into manifest entry of partition, time range is kept as ISO strings"""
+    entry['rows'] += 1
+    if entry['first'] is None or row[start] < entry['first']:
+        entry['first'] = row[start]
+    if entry['last'] is None or row[end] > entry['last']:
+        entry['last'] = row[end]
+
+def next_month(month):
+    """Returns month (YYYY-MM) following the given one"""
+    year, number = int(month[:4]), int(month[5:7])
+    return '%04d-%02d' % (year + number // 12, number % 12 + 1)
+
+class PartitionWriter:
+    """CSV writer of month partition, rows are counted into its manifest entry"""
+
+    def __init__(self, path, mode, entry, start, end):
+        self.file = open(path, mode, newline='\n', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.entry = entry
+        self.start = start
+        self.end = end
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        track(self.entry, row, self.start, self.end)
+
+    def close(self):
+        self.file.close()
+
+class Partitions:
+    """
+        Rows of year file are stored in directory next to it, one CSV file
+        without head for every month (YYYY-MM.csv). Manifest in the same
+        directory records whether year file has head and row count, time
+        range (columns start and end of rows) and hash of every partition,
+        files of months missing in manifest are ignored.
+
+        Month written for the first time in run replaces its partition, year
+        file is assembled by concatenating partitions in order of months.
+        Partitions and manifest are written through transaction, so they are
+        committed or rolled back together with the year file. Year file stored
+        before partitions existed is split into them first.
+    """
+
+    def __init__(self, transaction, filename, head, start=0, end=0, rebuild=False):
+        self.transaction = transaction
+        self.filename = filename
+        self.head = head
+        self.start = start
+        self.end = end
+        self.directory = os.path.splitext(filename)[0]
+        self.manifest = os.path.join(self.directory, MANIFEST)
+        # Months already written by this run, more tables of month are appended
+        self.written = set()
+        os.makedirs(self.directory, exist_ok=True)
+
+        if rebuild:
+            self.entries = {'head': True, 'partitions': {}}
+            self.save()
+            return
+        try:
+            with open(transaction.current(self.manifest), encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            # New year file gets head, stored one keeps what it has
+            self.entries = {'head': not os.path.exists(filename), 'partitions': {}}
+            if os.path.exists(filename):
+                self.split()
+            self.save()
+
+    def partition(self, month):
+        return os.path.join(self.directory, month + '.csv')
+
+    def save(self):
+        path = self.transaction.path(self.manifest, truncate=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+    def head_line(self):
+        line = io.StringIO(newline='')
+        csv.writer(line).writerow(self.head)
+        return line.getvalue().encode('utf-8')
+
+    def split(self):
+        """
+            Splits year file into partitions by month of rows, lines are
+            copied as they are. Source sometimes dates whole table of month
+            wrongly, rows dated before month of preceding rows are kept in
+            partition of the month following them (month they were imported
+            for), so rerun of that month replaces them and assembled year file
+            is the same as the original one.
+        """
+        logging.info('Splitting %s into month partitions', self.filename)
+        files = {}
+        month = None
+        previous = None
+        try:
+            with open(self.filename, 'rb') as f:
+                for number, line in enumerate(f):
+                    row = next(csv.reader([line.decode('utf-8')]))
+                    # Head written with older table_head is replaced by current one
+                    if number == 0 and (line == self.head_line() or not row[self.start][:4].isdigit()):
+                        self.entries['head'] = True
+                        continue
+                    dated = row[self.start][:7]
+                    if month is None or dated > month:
+                        month = dated
+                    elif dated < month and previous >= month:
+                        # First row of wrongly dated table, December of year keeps it
+                        following = next_month(month)
+                        if following[:4] == month[:4]:
+                            month = following
+                        logging.warning('Rows of %s dated %s are kept in partition %s', self.filename,
+                                        row[self.start], month)
+                    previous = dated
+                    if month not in files:
+                        files[month] = open(self.transaction.path(self.partition(month), truncate=True), 'wb')
+                        self.entries['partitions'][month] = {'rows': 0, 'first': None, 'last': None}
+                    files[month].write(line)
+                    track(self.entries['partitions'][month], row, self.start, self.end)
+        finally:
+            for f in files.values():
+                f.close()
+        for month in files:
+            self.record(month)
+
+    def open(self, month):
+        """
+            Returns writer of partition of month (YYYY-MM), partition is
+            replaced on the first call in run and appended on later ones.
+            Writer has to be passed to close() once rows are written.
+        """
+        path = self.transaction.path(self.partition(month), truncate=True)
+        if month in self.written:
+            mode = 'a'
+        else:
+            mode = 'w'
+            self.written.add(month)
+            self.entries['partitions'][month] = {'rows': 0, 'first': None, 'last': None}
+        return PartitionWriter(path, mode, self.entries['partitions'][month], self.start, self.end)
+
+    def close(self, month, writer):
+        """Closes writer and records partition of month in manifest"""
+        writer.close()
+        self.record(month)
+        self.save()
+
+    def record(self, month):
+        path = self.transaction.current(self.partition(month))
+        self.entries['partitions'][month]['sha256'] = file_sha256(path)
+
+    def rows(self):
+        """Returns number of rows of all partitions"""
+        return sum(entry['rows'] for entry in self.entries['partitions'].values())
+
+    def read(self, months):
+        """Yields rows of partitions of months, partitions are read from disk one by one"""
+        for month in sorted(months):
+            with open(self.transaction.current(self.partition(month)), newline='', encoding='utf-8') as f:
+                yield from csv.reader(f)
+
+    def written_rows(self):
+        """Returns number of rows of months written by this run"""
+        return sum(self.entries['partitions'][month]['rows'] for month in self.written)
+
+    def assemble(self):
+        """Writes temporary file of year file by concatenating partitions, returns its path"""
+        path = self.transaction.path(self.filename, truncate=True)
+        with open(path, 'wb') as f:
+            if self.entries['head'] and self.rows():
+                f.write(self.head_line())
+            for month in sorted(self.entries['partitions']):
+                with open(self.transaction.current(self.partition(month)), 'rb') as partition:
+                    shutil.copyfileobj(partition, f)
+        return path
@@ -0,0 +1,27 @@
+"""
+Bounded worker pool used for concurrent downloading
+"""
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+def ordered_map(func, iterable, workers):
+    """
+        Like map(), but func is called in pool of threads. At most `workers`
+        calls are in flight at once and results are yielded in the same order
+        as items of iterable, so callers can write them out deterministically.
+        Exception raised by func (including exit()) is re-raised in caller.
+    """
+    if workers <= 1:
+        yield from map(func, iterable)
+        return
+
+    # Workers are named after caller, so log records can be told apart by pipeline
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=threading.current_thread().name) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
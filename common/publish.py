@@ -0,0 +1,149 @@
+"""
+Transactional writing of year files, replaces backing up of every year
+into .old copies
+"""
+import os
+import json
+import logging
+import threading
+from shutil import copyfile
+
+def fsync_file(filename):
+    with open(filename, 'rb+') as f:
+        os.fsync(f.fileno())
+
+def fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write(filename, write):
+    """Calls write(f) on temporary file and atomically renames it to filename"""
+    with open(filename + '.tmp', 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + '.tmp', filename)
+
+class Transaction:
+    """
+        Year files are never modified in place. First write of a run into year
+        file copies it (unless it is rewritten from scratch) into temporary
+        file next to it, all writes and uploads use the temporary file and
+        commit() fsyncs it and atomically renames it over the year file.
+
+        Small journal records touched files and resources uploaded from them,
+        so rollback() only removes temporary files and re-sends original files
+        of touched years into the same resources. Journal left behind by run
+        that crashed is rolled back by the next one. Files of different years
+        may be written and uploaded from worker threads.
+    """
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.lock = threading.RLock()
+        try:
+            with open(journal, encoding='utf-8') as f:
+                self.files = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+
+    def pending(self):
+        """True if journal of unfinished run exists"""
+        return bool(self.files)
+
+    def save(self):
+        if not self.files:
+            try:
+                os.remove(self.journal)
+            except FileNotFoundError:
+                pass
+            return
+        data = json.dumps(self.files, indent=1).encode('utf-8')
+        atomic_write(self.journal, lambda f: f.write(data))
+
+    def path(self, filename, truncate=False):
+        """
+            Returns temporary file to be written instead of filename. On first
+            call it contains current content of filename, or nothing if
+            truncate is set (file is rewritten from scratch).
+        """
+        with self.lock:
+            if filename in self.files:
+                return self.files[filename]['tmp']
+
+            tmp = filename + '.tmp'
+            existed = os.path.exists(filename)
+            if existed and not truncate:
+                copyfile(filename, tmp)
+            else:
+                open(tmp, 'w').close()
+            self.files[filename] = {'tmp': tmp, 'existed': existed, 'resources': {}}
+            self.save()
+            return tmp
+
+    def current(self, filename):
+        """Returns file with current content of filename, its temporary file if this run touched it"""
+        with self.lock:
+            return self.files[filename]['tmp'] if filename in self.files else filename
+
+    def uploaded(self, filename, resource_id, created=False):
+        """Records that temporary file of filename was uploaded into resource"""
+        with self.lock:
+            resources = self.files[filename]['resources']
+            # Resource created by this run stays created on later uploads
+            resources[resource_id] = resources.get(resource_id, False) or created
+            self.save()
+
+    def commit(self):
+        """Replaces year files by their temporary files"""
+        directories = set()
+        for filename, entry in self.files.items():
+            fsync_file(entry['tmp'])
+            os.replace(entry['tmp'], filename)
+            directories.add(os.path.dirname(filename) or '.')
+        for directory in directories:
+            fsync_dir(directory)
+        self.files = {}
+        self.save()
+
+    def rollback(self, restore):
+        """
+            Drops temporary files and calls restore(resource_id, filename) for
+            resources uploaded by this run, filename is original file to be
+            re-sent or None if resource was created by this run and should be
+            deleted. Returns False if some resource couldn't be restored,
+            journal is kept then, so next run tries again.
+        """
+        success = True
+        for filename, entry in self.files.items():
+            logging.error('Rollback of %s in progress', filename)
+            try:
+                os.remove(entry['tmp'])
+            except FileNotFoundError:
+                pass
+            for resource_id, created in entry['resources'].items():
+                if created:
+                    restored = restore(resource_id, None)
+                elif entry['existed']:
+                    restored = restore(resource_id, filename)
+                else:
+                    logging.critical('There is no original of %s to restore resource %s', filename, resource_id)
+                    restored = False
+                if restored:
+                    entry['resources'][resource_id] = None
+                else:
+                    success = False
+                    logging.critical('FATAL ERROR: Rollback of resource %s failed', resource_id)
+
+        if success:
+            self.files = {}
+        else:
+            # Keep only resources that still need to be restored
+            for entry in self.files.values():
+                entry['resources'] = {resource_id: created for resource_id, created in entry['resources'].items()
+                                      if created is not None}
+        self.save()
+        return success
@@ -0,0 +1,85 @@
+"""
+Streaming multipart/form-data body of file upload, file is read from disk
+in chunks while it is sent instead of being encoded into memory first
+"""
+import os
+import gzip
+import uuid
+import shutil
+import tempfile
+import mimetypes
+
+CHUNK_SIZE = 1 << 16
+
+def field(boundary, name, value):
+    return ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+            % (boundary, name, value)).encode('utf-8')
+
+class MultipartUpload:
+    """
+        Body of multipart request made of form fields and one file. It is
+        iterable (requests streams it) and has length (Content-Length is
+        sent instead of chunked encoding). Every iteration starts from the
+        beginning of file, so request can be repeated by retrying session.
+        With gzip file is compressed into anonymous temporary file first,
+        its size has to be known before sending. File handles are closed by
+        close() or at the end of with block.
+    """
+
+    # Body can be sent again, see connections.resendable()
+    resendable = True
+
+    def __init__(self, fields, name, filename, gzip_file=False):
+        self.boundary = uuid.uuid4().hex
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        upload_name = os.path.basename(filename)
+        # Temporary file of transaction is uploaded under name of file it replaces
+        if upload_name.endswith('.tmp'):
+            upload_name = upload_name[:-len('.tmp')]
+        content_type = mimetypes.guess_type(upload_name)[0] or 'application/octet-stream'
+        if gzip_file:
+            self.file = self.compress(self.file)
+            upload_name += '.gz'
+            content_type = 'application/gzip'
+        self.file_size = self.file.seek(0, os.SEEK_END)
+
+        self.head = b''.join(field(self.boundary, key, value) for key, value in fields.items() if value is not None)
+        self.head += ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n'
+                      % (self.boundary, name, upload_name, content_type)).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+
+    @staticmethod
+    def compress(source):
+        """Returns anonymous temporary file with gzipped content of source, source is closed"""
+        compressed = tempfile.TemporaryFile()
+        try:
+            with source, gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+                shutil.copyfileobj(source, f, CHUNK_SIZE)
+        except BaseException:
+            compressed.close()
+            raise
+        return compressed
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self):
+        self.file.seek(0)
+        yield self.head
+        for chunk in iter(lambda: self.file.read(CHUNK_SIZE), b''):
+            yield chunk
+        yield self.tail
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,115 @@
+"""
+Streaming conversion of City Council's session XML (<schuze>) into
+normalized tables of sessions, agenda items, resolutions and member votes
+"""
+import os
+import csv
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+from common.publish import fsync_file
+
+# Columns of tables, rows are joined by datum (session), bod_id and usneseni_id
+TABLES = {
+    'schuze': ['datum', 'nazev'],
+    'body': ['bod_id', 'datum', 'cislo', 'cj', 'nazev'],
+    'usneseni': ['usneseni_id', 'bod_id', 'cislo', 'text'],
+    'hlasovani': ['usneseni_id', 'clen', 'hlas'],
+}
+
+# Names of tables published as resources
+TITLES = {
+    'schuze': 'Zasedání',
+    'body': 'Body programu',
+    'usneseni': 'Usnesení',
+    'hlasovani': 'Hlasování členů',
+}
+
+# Options of vote, one element with <clen> children for each
+VOTES = ('pro', 'proti', 'zdrzel_se', 'nehlasoval', 'nepritomen', 'omluven')
+
+def text(element, tag):
+    return (element.findtext(tag) or '').strip()
+
+def members(option):
+    """
+        Yields names of members in option of vote. Export splits names at
+        comma, so post-nominal title ("Ing. Martin Mrkos, ACCA") ends up in
+        its own <clen>. Such element (name without space) is joined back.
+    """
+    name = None
+    for element in option.iter('clen'):
+        value = (element.text or '').strip()
+        if not value:
+            continue
+        if name is not None and ' ' not in value:
+            name += ', ' + value
+            continue
+        if name is not None:
+            yield name
+        name = value
+    if name is not None:
+        yield name
+
+def convert_session(source):
+    """
+        Parses session XML file incrementally and yields (table, row) tuples.
+        Resolutions and agenda items are removed from tree as soon as their
+        rows are yielded, so only one of them is held in memory.
+    """
+    stack = []
+    date = None
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(element)
+            continue
+        stack.pop()
+        parent = stack[-1] if stack else None
+
+        if element.tag == 'datum' and len(stack) == 1:
+            date = datetime.strptime(element.text.strip(), '%d.%m.%Y').strftime('%Y-%m-%d')
+        elif element.tag == 'usneseni':
+            usneseni_id = text(element, 'id')
+            yield 'usneseni', [usneseni_id, text(parent, 'bod_id'), text(element, 'cislo'), text(element, 'text')]
+            for vote in element.iter('hlasovani'):
+                for option in VOTES:
+                    voters = vote.find(option)
+                    if voters is None:
+                        continue
+                    for member in members(voters):
+                        yield 'hlasovani', [usneseni_id, member, option]
+            parent.remove(element)
+        elif element.tag == 'bod':
+            yield 'body', [text(element, 'bod_id'), date, text(element, 'cislo'), text(element, 'cj'),
+                           text(element, 'nazev')]
+            parent.remove(element)
+        elif element.tag == 'schuze':
+            yield 'schuze', [date, text(element, 'nazev')]
+            element.clear()
+
+def convert(sources, directory):
+    """
+        Converts session files into CSV file of every table in directory,
+        rows of all sessions in order of sources. Files are replaced only
+        once all sessions are converted. Returns {table: filename}.
+    """
+    os.makedirs(directory, exist_ok=True)
+    filenames = {table: os.path.join(directory, table + '.csv') for table in TABLES}
+    files = {}
+    try:
+        writers = {}
+        for table, head in TABLES.items():
+            files[table] = open(filenames[table] + '.tmp', 'w', newline='', encoding='utf-8')
+            writers[table] = csv.writer(files[table])
+            writers[table].writerow(head)
+        for source in sources:
+            for table, row in convert_session(source):
+                writers[table].writerow(row)
+    finally:
+        for f in files.values():
+            f.close()
+
+    for filename in filenames.values():
+        fsync_file(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+    return filenames
@@ -0,0 +1,180 @@
+"""
+SQLite index of City Council's voting archive, so votes of a member or
+results of resolution are looked up without parsing session files again
+"""
+import os
+import sqlite3
+import logging
+
+from common import voting
+from common.manifest import file_sha256
+
+# Members and vote options are stored once and referenced by number
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS soubory (
+    soubor TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    datum TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS schuze (
+    datum TEXT PRIMARY KEY,
+    nazev TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS body (
+    bod_id INTEGER PRIMARY KEY,
+    datum TEXT NOT NULL,
+    cislo TEXT NOT NULL,
+    cj TEXT NOT NULL,
+    nazev TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usneseni (
+    usneseni_id INTEGER PRIMARY KEY,
+    bod_id INTEGER NOT NULL,
+    cislo TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS clenove (
+    clen_id INTEGER PRIMARY KEY,
+    jmeno TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS hlasy (
+    hlas_id INTEGER PRIMARY KEY,
+    hlas TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS hlasovani (
+    usneseni_id INTEGER NOT NULL,
+    clen_id INTEGER NOT NULL,
+    hlas_id INTEGER NOT NULL,
+    PRIMARY KEY (usneseni_id, clen_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS body_datum ON body (datum);
+CREATE INDEX IF NOT EXISTS usneseni_bod ON usneseni (bod_id);
+CREATE INDEX IF NOT EXISTS hlasovani_clen ON hlasovani (clen_id, usneseni_id);
+CREATE INDEX IF NOT EXISTS hlasovani_hlas ON hlasovani (hlas_id, usneseni_id);
+"""
+
+# Votes joined with everything needed to print them
+VOTES = """
+SELECT body.datum, usneseni.usneseni_id, body.cislo, usneseni.cislo, body.nazev, clenove.jmeno, hlasy.hlas
+FROM hlasovani
+JOIN usneseni USING (usneseni_id)
+JOIN body USING (bod_id)
+JOIN clenove USING (clen_id)
+JOIN hlasy USING (hlas_id)
+"""
+
+class VotingIndex:
+    """
+        Index of session files kept in SQLite database. Every file is indexed
+        in one transaction, file with the same hash as when it was indexed
+        is skipped, changed one replaces rows of its session.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.db.executemany('INSERT OR IGNORE INTO hlasy (hlas_id, hlas) VALUES (?, ?)', enumerate(voting.VOTES))
+        self.db.commit()
+        self.votes = {vote: id for id, vote in enumerate(voting.VOTES)}
+        self.members = dict(self.db.execute('SELECT jmeno, clen_id FROM clenove'))
+
+    def close(self):
+        self.db.close()
+
+    def member_id(self, name):
+        if name not in self.members:
+            cursor = self.db.execute('INSERT INTO clenove (jmeno) VALUES (?)', (name,))
+            self.members[name] = cursor.lastrowid
+        return self.members[name]
+
+    def _delete(self, date):
+        self.db.execute('DELETE FROM hlasovani WHERE usneseni_id IN (SELECT usneseni_id FROM usneseni '
+                        'WHERE bod_id IN (SELECT bod_id FROM body WHERE datum = ?))', (date,))
+        self.db.execute('DELETE FROM usneseni WHERE bod_id IN (SELECT bod_id FROM body WHERE datum = ?)', (date,))
+        self.db.execute('DELETE FROM body WHERE datum = ?', (date,))
+        self.db.execute('DELETE FROM schuze WHERE datum = ?', (date,))
+
+    def update(self, filename):
+        """Indexes session file, returns False if it is unchanged since it was indexed"""
+        key = os.path.basename(filename)
+        sha256 = file_sha256(filename)
+        row = self.db.execute('SELECT sha256, datum FROM soubory WHERE soubor = ?', (key,)).fetchone()
+        if row is not None and row[0] == sha256:
+            return False
+
+        try:
+            with self.db:
+                if row is not None:
+                    self._delete(row[1])
+                date = None
+                for table, values in voting.convert_session(filename):
+                    if table == 'hlasovani':
+                        usneseni_id, member, vote = values
+                        self.db.execute('INSERT OR REPLACE INTO hlasovani VALUES (?, ?, ?)',
+                                        (usneseni_id, self.member_id(member), self.votes[vote]))
+                    elif table == 'usneseni':
+                        self.db.execute('INSERT OR REPLACE INTO usneseni VALUES (?, ?, ?, ?)', values)
+                    elif table == 'body':
+                        self.db.execute('INSERT OR REPLACE INTO body VALUES (?, ?, ?, ?, ?)', values)
+                    else:
+                        date = values[0]
+                        self.db.execute('INSERT OR REPLACE INTO schuze VALUES (?, ?)', values)
+                self.db.execute('INSERT OR REPLACE INTO soubory VALUES (?, ?, ?)', (key, sha256, date))
+        except Exception:
+            # Members inserted by rolled back transaction are gone
+            self.members = dict(self.db.execute('SELECT jmeno, clen_id FROM clenove'))
+            raise
+        logging.info('Session %s indexed', date)
+        return True
+
+    def sync(self, filenames):
+        """Indexes all session files, sessions of removed files are dropped. Returns number of indexed files."""
+        indexed = sum(self.update(filename) for filename in filenames)
+        keys = {os.path.basename(filename) for filename in filenames}
+        with self.db:
+            for key, date in self.db.execute('SELECT soubor, datum FROM soubory').fetchall():
+                if key not in keys:
+                    self._delete(date)
+                    self.db.execute('DELETE FROM soubory WHERE soubor = ?', (key,))
+        return indexed
+
+    def find_members(self, pattern):
+        """Returns names of members containing pattern"""
+        return [name for name, in self.db.execute('SELECT jmeno FROM clenove WHERE jmeno LIKE ? ORDER BY jmeno',
+                                                  ('%' + pattern + '%',))]
+
+    def member_votes(self, name, since=None, until=None, vote=None):
+        """Returns votes of member ordered by date, optionally only from since to until (YYYY-MM-DD) and of one option"""
+        query = VOTES + 'WHERE hlasovani.clen_id = (SELECT clen_id FROM clenove WHERE jmeno = ?)'
+        parameters = [name]
+        if since:
+            query += ' AND body.datum >= ?'
+            parameters.append(since)
+        if until:
+            query += ' AND body.datum <= ?'
+            parameters.append(until)
+        if vote:
+            query += ' AND hlasovani.hlas_id = ?'
+            parameters.append(self.votes[vote])
+        return self.db.execute(query + ' ORDER BY body.datum, usneseni.usneseni_id', parameters).fetchall()
+
+    def resolution(self, usneseni_id):
+        """Returns (date, item, text) of resolution and its votes, None if it is not indexed"""
+        row = self.db.execute('SELECT body.datum, body.nazev, usneseni.text FROM usneseni JOIN body USING (bod_id) '
+                              'WHERE usneseni_id = ?', (usneseni_id,)).fetchone()
+        if row is None:
+            return None
+        votes = self.db.execute(VOTES + 'WHERE hlasovani.usneseni_id = ? ORDER BY hlasovani.hlas_id, clenove.jmeno',
+                                (usneseni_id,)).fetchall()
+        return row, votes
+
+    def session_votes(self, date, vote=None):
+        """Returns votes of all resolutions of session held on date, optionally only of one option"""
+        query = VOTES + 'WHERE body.datum = ?'
+        parameters = [date]
+        if vote:
+            query += ' AND hlasovani.hlas_id = ?'
+            parameters.append(self.votes[vote])
+        return self.db.execute(query + ' ORDER BY usneseni.usneseni_id, hlasovani.hlas_id, clenove.jmeno',
+                               parameters).fetchall()
@@ -4,15 +4,33 @@ This script is used for automatic publication of Evmapy datas
 into CKAN
 """
 import os
+import io
+import sys
 import csv
 import argparse
-from shutil import copyfile
+import calendar
+import threading
 from datetime import datetime
+from http.cookiejar import LWPCookieJar, LoadError
 import logging
 import requests
 from bs4 import BeautifulSoup
+from lxml import etree
 import toml
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from common.pool import ordered_map
+from common.manifest import Manifest
+from common.publish import Transaction
+from common.partitions import Partitions
+from common import cache as response_cache
+from common import connections
+from common.ckan import datapusher_push
+from common import ckan as ckan_client
+from common.datasets import Publisher
+from common import metrics as run_metrics
+from common import aggregates
+
 EXIT_REQUEST_ERROR = 1
 EXIT_ROLLBACK_SUCCESS = 2
 EXIT_ROLLBACK_ERROR = 3
@@ -20,21 +38,107 @@ EXIT_MISSING_CONFIG = 5
 EXIT_ARGUMENT_ERROR = 6
 EXIT_FILE_ERROR = 7
 
+# Level of elektronabijecky.log, orchestrator logs the script with it too
+LOG_LEVEL = logging.DEBUG
+
+session = None
+login_lock = threading.Lock()
+login_count = 0
+# Turns cleaned rows into published ones, built from config once per run
+transform = None
+# Timings and counters of run, disabled unless metrics_dir is configured
+metrics = run_metrics.NULL
+
+def load_cookies(session):
+    """Restores login cookies saved by previous run, returns False if there are none"""
+    jar = LWPCookieJar(cookie_jar_path)
+    try:
+        jar.load(ignore_discard=True, ignore_expires=True)
+    except (OSError, LoadError):
+        return False
+    session.cookies.update(jar)
+    return len(jar) > 0
+
+def save_cookies(session):
+    """Stores login cookies, so next cron run can skip login"""
+    jar = LWPCookieJar(cookie_jar_path)
+    for cookie in session.cookies:
+        jar.set_cookie(cookie)
+    try:
+        jar.save(ignore_discard=True, ignore_expires=True)
+        os.chmod(cookie_jar_path, 0o600)
+    except OSError as e:
+        logging.warning('Could not save cookies: %s', e)
+
+def login(session):
+    """Logs session into Evmapy"""
+    global login_count
+    logging.info('Logging into Evmapy')
+    session.cookies.clear()
+    try:
+        request = session.post(config['post_login_url'], data=config['payload'])
+        request.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.error(e)
+        logging.error('Login request failed. Exiting...')
+        exit(EXIT_REQUEST_ERROR)
+    login_count += 1
+    metrics.count('logins_total')
+    save_cookies(session)
+
+def logged_out(response):
+    """Evmapy answers with login form instead of stats once login expires"""
+    login_page = config['post_login_url'].rsplit('/', 1)[-1]
+    return login_page in response.url or 'action="' + login_page in response.text
+
+def too_many_attempts(response):
+    """Evmapy answers with TooManyAttemptsError page when it is queried too often"""
+    return 'TooManyAttempts' in response.text or 'Too Many Attempts' in response.text
+
+def valid_page(response):
+    """Only stats pages with detail table are cached, login, throttle and error pages never"""
+    return (not logged_out(response) and not too_many_attempts(response)
+            and response.text.lower().count('<table') >= 2)
+
+def get_session():
+    """
+        Returns one keep-alive session shared by the whole run. Login is done
+        only once (or never if saved cookies are still valid), logging in for
+        every request is what triggers TooManyAttemptsError.
+    """
+    global session
+    with login_lock:
+        if session is None:
+            # Keep-alive connections come from pools shared with other pipelines,
+            # Evmapy is rate limited and failed requests are retried
+            session = metrics.instrument(connections.session(config.get('retries', connections.RETRIES),
+                                                             config.get('rate_limit'), too_many_attempts))
+            if load_cookies(session):
+                logging.info('Reusing saved Evmapy login')
+            else:
+                login(session)
+    return session
+
 def get_data(url, period, station, pump):
     """Scrape data from web"""
-    with requests.Session() as session:
-        session.post(config['post_login_url'], data=config['payload'])
-        # Prevention against TooManyAttemptsError.
-        # I have run into this problem just once, if server complaints
-        # about too many attemps it's better to use `sleep(1)`.
-        # Keeping it here just for documentation purposes, run into this
-        # error only once or twice.
+    url = (url + '&owner=0&period=' +
+           str(period) + '&station=' +
+           str(station) + '&pump=' + str(pump))
+    # Closed months never change, they are served from cache without login
+    key = cache.key('GET', url)
+    immutable = str(period) < datetime.now().strftime('%Y%m')
+    request = cache.fresh(key)
+    if request is not None:
+        return request
+
+    session = get_session()
+    # Second attempt is made after relogin, when saved or current login expired.
+    for attempt in range(2):
+        seen_login = login_count
         try:
-            request = session.get(
-                url + '&owner=0&period=' +
-                str(period) + '&station=' +
-                str(station) + '&pump=' + str(pump)
-            )
+            request = session.get(url, headers=cache.validators(key))
+            request.raise_for_status()
+        # Transient errors were already retried by session, these are permanent
         except requests.exceptions.ConnectionError as e:
             logging.error(e)
             logging.error('Request for retrieving table data failed. Exiting...')
@@ -48,9 +152,57 @@ def get_data(url, period, station, pump):
             logging.error('Request for retrieving table data failed. Exiting...')
             exit(EXIT_REQUEST_ERROR)
 
-        return request
+        # Throttle page comes with status 200, session already retried it
+        if too_many_attempts(request):
+            logging.error('Evmapy still answers TooManyAttempts after retries. Exiting...')
+            exit(EXIT_REQUEST_ERROR)
+
+        if not logged_out(request):
+            return cache.store(key, request, immutable, valid_page)
+
+        with login_lock:
+            # Other worker may have already logged in again meanwhile
+            if seen_login == login_count:
+                logging.info('Evmapy login expired')
+                login(session)
+
+    logging.error('Could not log into Evmapy. Exiting...')
+    exit(EXIT_REQUEST_ERROR)
 
 def clean_data(raw_data):
+    """
+        Removes data that are not suitable for publishing. Page is parsed
+        only until end of second table "Detail" and only cells with time
+        interval and consumption are taken from it.
+    """
+    if config.get('html_parser') == 'bs4':
+        return clean_data_bs4(raw_data)
+
+    source = io.BytesIO(raw_data.content)
+    table = None
+    tables_seen = 0
+    for event, element in etree.iterparse(source, events=('start', 'end'), tag='table',
+                                          html=True, encoding=raw_data.encoding):
+        if event == 'start':
+            tables_seen += 1
+            if tables_seen == 2: # Choose second table "Detail"
+                table = element
+        elif element is table:
+            break
+    else:
+        logging.info('Skipping - no data table')
+        return 1
+
+    # First row is table header, second is subheader and last one is total
+    rows = table.findall('.//tr')[2:-1]
+    list_of_rows = []
+    for row in rows:
+        cells = row.findall('.//td')
+        list_of_rows.append([''.join(cells[1].itertext()), ''.join(cells[4].itertext())])
+
+    return list_of_rows
+
+def clean_data_bs4(raw_data):
     """ Removes data that are not suitable for publishing """
     tree = BeautifulSoup(raw_data.text, "lxml")
     try:
@@ -81,296 +233,334 @@ def clean_data(raw_data):
 
     return list_of_rows
 
-def prepare_data(list_of_rows, station, socket):
+class RowTransform:
     """
         Prepares data for publishing and neccessary data to conform Open Normal Form of datas.
         https://github.com/opendata-mvcr/otevrene-formalni-normy/issues/205
-    """
-    index = 0
-    for row in list_of_rows:
-        row[0] = row[0].split(' ')
-        del row[0][2] # Removed dash " - " separator from time
-        date = datetime.strptime(row[0][0], '%d.%m.%Y').strftime('%Y-%m-%d')
-
-        # YYYY-MM-DDTHH:MM:SS 'T' connects date and time (see: https://bit.ly/2y0iDP7)
-        row[0][1] = date + 'T' + row[0][1] + ':00'
-        row[0][2] = date + 'T' + row[0][2] + ':00'
-        del row[0][0]
-        consumption = row[1].split(' ')
-        iri = config['resource_iri'] + config['station_dict'][station] + '/' + config['socket_dict'][socket]
-        list_of_rows[index] = [iri] + row[0] + [consumption[0]] + [consumption[1].upper()]
-        index += 1
 
-    return list_of_rows
+        IRIs of all sockets are built once and every distinct date is
+        converted only once, rows are turned into output tuples in one pass.
+    """
 
-def month_year_iter(start_month, start_year, end_month, end_year):
+    def __init__(self, config):
+        self.iris = {(station, socket): config['resource_iri'] + station_name + '/' + socket_name
+                     for station, station_name in config['station_dict'].items()
+                     for socket, socket_name in config['socket_dict'].items()}
+        # 'DD.MM.YYYY' -> 'YYYY-MM-DDT'
+        self.dates = {}
+
+    def date(self, day):
+        prefix = self.dates.get(day)
+        if prefix is None:
+            # YYYY-MM-DDTHH:MM:SS 'T' connects date and time (see: https://bit.ly/2y0iDP7)
+            prefix = self.dates[day] = datetime.strptime(day, '%d.%m.%Y').strftime('%Y-%m-%d') + 'T'
+        return prefix
+
+    def __call__(self, list_of_rows, station, socket):
+        """Returns (IRI, start, end, consumption, unit) of cleaned rows [interval, consumption] of socket"""
+        iri = self.iris[station, socket]
+        date = self.date
+        rows = []
+        for interval, consumption in list_of_rows:
+            # 'DD.MM.YYYY HH:MM - HH:MM', dash is skipped
+            interval = interval.split(' ')
+            day = date(interval[0])
+            consumption = consumption.split(' ')
+            rows.append((iri, day + interval[1] + ':00', day + interval[3] + ':00', consumption[0],
+                         consumption[1].upper()))
+        return rows
+
+def month_year_jobs(start_month, start_year, end_month, end_year):
+    """Yields (year, month, period, station, socket) of every table to download"""
     ym_start = 12*start_year + start_month - 1
     ym_end = 12*end_year + end_month - 1
     for ym in range(ym_start, ym_end+1):
         y, m = divmod(ym, 12)
-        if m < 10:
+        # m is zero based, October used to be requested as YYYY010 and got January
+        if m + 1 < 10:
             current_date = str(y) + "0" + str(m + 1)
         else:
             current_date = str(y) + str(m + 1)
-        logging.info('Processing %s', current_date)
-        counter = 0
         for station in config['station_dict']:
             if station == '319':
                 sockets = ['343', '344']
             else: #station 351
                 sockets = ['391']
             for socket in sockets:
-                raw_table = get_data(config['request_url'], current_date, station, socket)
-
-                # list_of_rows contains prepared unprocessed data in list,
-                # where each item is one row [[row], [row], [row]...]
-                list_of_rows = clean_data(raw_table)
-                logging.info('Data for %s cleaned', current_date)
-
-                counter += 1
+                yield y, m+1, current_date, station, socket
 
-                # if table is empty, return empty list
-                if list_of_rows == 1:
-                    yield 'Err - empty table', y, m+1, counter
-                else:
-                    # data contains final form of datas, prepared to be written into file
-                    data = prepare_data(list_of_rows, station, socket)
-                    logging.info('Data for %s prepared', current_date)
+def fetch_table(job):
+    """Downloads and cleans table of one socket, runs in worker thread"""
+    y, m, current_date, station, socket = job
+    logging.info('Processing %s station %s socket %s', current_date, station, socket)
+    with metrics.stage('fetch'):
+        raw_table = get_data(config['request_url'], current_date, station, socket)
 
-                    yield data, y, m+1, counter
+    # list_of_rows contains prepared unprocessed data in list,
+    # where each item is one row [[row], [row], [row]...]
+    with metrics.stage('clean'):
+        list_of_rows = clean_data(raw_table)
+    logging.info('Data for %s cleaned', current_date)
 
-def ckan_post_request(url, action, data, headers, filename):
-    """
-        Wrapper around request call to provide neccessary parameters.
-    """
-    if filename:
-        files = [('upload', open(filename, 'rb'))]
-    else:
-        files = None
-    try:
-        r = requests.post(url + action,
-                          data=data,
-                          headers=headers,
-                          files=files)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        logging.error(e)
-        logging.error(r.text)
-        return EXIT_REQUEST_ERROR
-    except requests.exceptions.RequestException as e:
-        logging.error(e)
-        logging.error(r.text)
-        return EXIT_REQUEST_ERROR
-
-    if action in ['package_show', 'package_create']:
-        return r
-    else:
-        return 0
+    return job, list_of_rows
 
-def rollback(location, start_year, end_year):
-    rollback_error = False
-    for year in range(start_year, end_year+1):
-        logging.error('Rollback of year %s in progress', year)
-        filename = location + '/'  + config['filename'] + str(year) + config['extension']
-
-        try:
-            # Remove corrupted files
-            os.remove(filename)
-
-            # Restore backed up files
-            copyfile(filename + '.old', filename)
-
-            # Remove old back ups
-            os.remove(filename + ".old")
-        except:
-            pass
-
-        extension = os.path.splitext(filename)[1][1:].upper()
-        logging.info('Creating "{resource_name}" resource'.format(**locals()))
-        data = {
-            'package_id': config['package'],
-            'name': year,
-            'format': extension,
-            'url': 'upload',  # Needed to pass validation
-        }
-        headers = {'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'resource_create', data, headers, filename)
+def month_year_iter(start_month, start_year, end_month, end_year):
+    jobs = month_year_jobs(start_month, start_year, end_month, end_year)
+    # Tables are downloaded concurrently, but yielded in the same order as jobs
+    for job, list_of_rows in ordered_map(fetch_table, jobs, workers):
+        y, m, current_date, station, socket = job
+
+        # if table is empty, return empty list
+        if list_of_rows == 1:
+            yield 'Err - empty table', y, m, station, socket
+        else:
+            # data contains final form of datas, prepared to be written into file
+            with metrics.stage('prepare'):
+                data = transform(list_of_rows, station, socket)
+            metrics.count('rows_total', len(data))
+            logging.info('Data for %s prepared', current_date)
 
-        if r == EXIT_REQUEST_ERROR:
-            rollback_error = True
-            logging.critical('FATAL ERROR: Rollback for year %s failed, trying to rollback the rest', year)
+            yield data, y, m, station, socket
 
-    if rollback_error:
-        return EXIT_ROLLBACK_ERROR
+SUMMARY_HEAD = ['obdobi', 'datum', 'nabijeci_stanice', 'pocet_nabijeni', 'pocet_prazdnych_nabijeni', 'spotreba_kwh',
+                'obsazenost_hodin', 'vyuziti']
 
-    return EXIT_ROLLBACK_SUCCESS
+MINUTES_PER_DAY = 24 * 60
 
-parser = argparse.ArgumentParser(description='Import Evmapy data to CKAN')
+def summary_filename(filename, extension):
+    """Returns name of summary file kept next to year file"""
+    return os.path.splitext(filename)[0] + config['summary'].get('suffix', '_souhrn') + extension
 
-parser.add_argument('-sy','--start-year', action='store', type=int, required='True', help='start year of import')
-parser.add_argument('-sm','--start-month', action='store', type=int, required='True', help='start month of import')
-parser.add_argument('-ey', '--end-year', action='store', type=int, required='True', help='end year of import')
-parser.add_argument('-em', '--end-month', action='store', type=int, required='True',help='end month of import')
+def session_partials(rows):
+    """
+        Computes partial aggregates [sessions, empty sessions, kWh, occupied
+        hours] of every socket and day of prepared rows, keyed by
+        'socket IRI|YYYY-MM-DD'. Session belongs to the day it started on.
+        Source gives only date of start, so session over midnight ends
+        before it started and its length is taken modulo one day. Sessions
+        of zero length or with 0.000 kWh are counted only as empty ones.
+    """
+    if not rows:
+        return {}
+    table = aggregates.table(rows)
+    iris, sockets = aggregates.encode(table[:, 0])
+    start = aggregates.minutes(table[:, 1])
+    length = (aggregates.minutes(table[:, 2]) - start) % MINUTES_PER_DAY
+    energy = table[:, 3].astype(float)
+    empty = (length == 0) | (energy == 0)
+    (sockets, days), _, sums = aggregates.sum_groups([sockets, start // MINUTES_PER_DAY],
+                                                     [~empty, empty, energy, length / 60])
+    return {iris[socket] + '|' + aggregates.day_string(day): [int(row[0]), int(row[1]), float(row[2]), float(row[3])]
+            for socket, day, row in zip(sockets, days, sums)}
+
+def stored_summary(storage):
+    """Computes summary state of year from all its stored month partitions"""
+    partials = {}
+    for month in storage.entries['partitions']:
+        for group, partial in session_partials(list(storage.read([month]))).items():
+            partials[month + '|' + group] = partial
+    return partials
+
+def update_summary(state, storage, month, iri, rows):
+    """
+        Replaces days of socket imported for month in summary state of year
+        and returns the state. Days are keyed by imported month too, source
+        sometimes dates whole table wrongly. Socket without sessions in month
+        has no days, stale ones are removed. State which is missing or empty
+        is rebuilt from stored partitions first, so other months are kept.
+    """
+    partials = aggregates.load(state)
+    if not partials:
+        partials = stored_summary(storage)
+    month_partials = session_partials(rows)
+    empty = sum(partial[1] for partial in month_partials.values())
+    if empty:
+        logging.warning('%s empty sessions (zero length or 0.000 kWh) in %s of %s', empty, month, iri)
+    aggregates.replace(partials, month + '|' + iri + '|',
+                       {month + '|' + group: partial for group, partial in month_partials.items()})
+    aggregates.save(state, partials)
+    return partials
+
+def period_days(date):
+    """Returns number of days of day, month or year given as YYYY-MM-DD, YYYY-MM or YYYY"""
+    parts = [int(part) for part in date.split('-')]
+    if len(parts) == 3:
+        return 1
+    if len(parts) == 2:
+        return calendar.monthrange(*parts)[1]
+    return 366 if calendar.isleap(parts[0]) else 365
 
-group_head = parser.add_mutually_exclusive_group(required=True)
-group_head.add_argument('--head', action='store_true', help='include head of table')
-group_head.add_argument('--no-head', action='store_true', help='do not include head of table')
+def write_summary(path, partials):
+    """
+        Writes daily, monthly and yearly summary of every socket into CSV
+        file, partials are keyed by 'imported month|socket IRI|YYYY-MM-DD'
+    """
+    # Wrongly dated table adds its days to days of other month
+    daily = aggregates.rollup(partials, lambda group: group.split('|', 1)[1], aggregates.add)
+    # 'IRI|YYYY-MM-DD' -> 'IRI|YYYY-MM' -> 'IRI|YYYY'
+    monthly = aggregates.rollup(daily, lambda group: group[:-3], aggregates.add)
+    yearly = aggregates.rollup(monthly, lambda group: group[:-3], aggregates.add)
+    with open(path, 'w', newline='\n', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(SUMMARY_HEAD)
+        for period, groups in (('den', daily), ('mesic', monthly), ('rok', yearly)):
+            for group in sorted(groups):
+                iri, date = group.rsplit('|', 1)
+                sessions, empty, energy, hours = groups[group]
+                writer.writerow([period, date, iri, sessions, empty, round(energy, 3), round(hours, 2),
+                                 round(hours / (24 * period_days(date)), 4)])
+
+def summary_resource(year, year_filename, partials):
+    """Returns summary of year as (stage, name, filename, write) of file derived from year file"""
+    return ('summary', config['package_name'] + str(year) + ' (souhrn nabíjení)',
+            summary_filename(year_filename, '.csv'), lambda path: write_summary(path, partials))
+
+def rollback():
+    if publisher.rollback():
+        return EXIT_ROLLBACK_SUCCESS
+
+    return EXIT_ROLLBACK_ERROR
+
+def main(argv=None):
+    """Imports Evmapy data of months given by arguments into CKAN, metrics are written at the end"""
+    code = EXIT_REQUEST_ERROR
+    try:
+        run(argv)
+        code = 0
+    except SystemExit as e:
+        code = e.code or 0
+        raise
+    finally:
+        metrics.finish(code if isinstance(code, int) else EXIT_REQUEST_ERROR)
 
-args = parser.parse_args()
+def run(argv):
+    global config, cookie_jar_path, workers, cache, transaction, publisher, metrics, transform
 
-dirname = os.path.realpath(__file__)
-location = dirname.rsplit('/',1)[0]
-filename = location + '/config.toml'
+    parser = argparse.ArgumentParser(description='Import Evmapy data to CKAN')
 
-logging.basicConfig(filename=location + "/elektronabijecky.log", level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser.add_argument('-sy','--start-year', action='store', type=int, required='True', help='start year of import')
+    parser.add_argument('-sm','--start-month', action='store', type=int, required='True', help='start month of import')
+    parser.add_argument('-ey', '--end-year', action='store', type=int, required='True', help='end year of import')
+    parser.add_argument('-em', '--end-month', action='store', type=int, required='True',help='end month of import')
 
-try:
-    config = toml.load(filename)
-except:
-    logging.error("Config file is missing. Exiting...")
-    exit(EXIT_MISSING_CONFIG)
+    group_head = parser.add_mutually_exclusive_group(required=True)
+    group_head.add_argument('--head', action='store_true', help='include head of table')
+    group_head.add_argument('--no-head', action='store_true', help='do not include head of table')
 
-if ((len(str(args.start_year)) != 4) or (len(str(args.end_year)) != 4)):
-    logging.error('Given year does not has 4 digits. Exiting...')
-    exit(EXIT_ARGUMENT_ERROR)
+    parser.add_argument('--publish', action='store', choices=['file', 'datastore', 'both'], default='file',
+                        help='upload whole year file, upsert only new rows into DataStore or both (default: file)')
 
-if ((len(str(args.start_month)) > 2) or (len(str(args.end_month)) > 2) and
-    (len(str(args.start_month)) <= 0) or (len(str(args.end_month)) <= 0)):
-    logging.error('Given month does not has 2 digits. Exiting...')
-    exit(EXIT_ARGUMENT_ERROR)
+    parser.add_argument('--no-cache', action='store_true', help='do not use cache of downloaded data')
+    parser.add_argument('-w', '--workers', action='store', type=int, help='number of tables downloaded at once (default from config)')
 
-if args.start_year > args.end_year:
-    logging.error('Starting month/year has to be smaller that ending month/year. Exiting...')
-    exit(EXIT_ARGUMENT_ERROR)
+    args = parser.parse_args(argv)
 
-logging.debug('Arguments parsed.')
-if args.head:
-    head_written = False
-if args.no_head:
-    head_written = True
+    dirname = os.path.realpath(__file__)
+    location = dirname.rsplit('/',1)[0]
+    filename = location + '/config.toml'
 
-for year in range(args.start_year, args.end_year+1):
-    filename = location + '/' + config['filename'] + str(year) + config['extension']
+    logging.basicConfig(filename=location + "/elektronabijecky.log", level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 
     try:
-        # Create backup of file being uploaded
-        copyfile(filename, filename + '.old')
-        logging.info('Backing up %s', filename)
-
-        if args.head:
-            os.remove(filename)
-            logging.info('Removed %s', filename)
+        config = toml.load(filename)
     except:
-        pass
+        logging.error("Config file is missing. Exiting...")
+        exit(EXIT_MISSING_CONFIG)
+
+    metrics = run_metrics.from_config('elektronabijecky', location, config)
+    transform = RowTransform(config)
+    cookie_jar_path = location + '/' + config.get('cookie_jar', '.evmapy_cookies')
+    workers = args.workers or config.get('workers', 4)
+    cache = response_cache.from_config(location, config, not args.no_cache)
+
+    if ((len(str(args.start_year)) != 4) or (len(str(args.end_year)) != 4)):
+        logging.error('Given year does not has 4 digits. Exiting...')
+        exit(EXIT_ARGUMENT_ERROR)
+
+    if ((len(str(args.start_month)) > 2) or (len(str(args.end_month)) > 2) and
+        (len(str(args.start_month)) <= 0) or (len(str(args.end_month)) <= 0)):
+        logging.error('Given month does not has 2 digits. Exiting...')
+        exit(EXIT_ARGUMENT_ERROR)
+
+    if args.start_year > args.end_year:
+        logging.error('Starting month/year has to be smaller that ending month/year. Exiting...')
+        exit(EXIT_ARGUMENT_ERROR)
+
+    logging.debug('Arguments parsed.')
+
+    # Year files are written into temporary files renamed over them at the end of run
+    transaction = Transaction(location + '/' + config.get('journal', 'backup/.journal.json'))
+    ckan = ckan_client.from_config(location, config, metrics)
+    publisher = Publisher(config, ckan, Manifest(location + '/' + config.get('manifest', 'backup/.manifest.json')),
+                          transaction, metrics)
+    if transaction.pending():
+        logging.warning('Previous run did not finish, rolling it back')
+        if not publisher.rollback():
+            exit(EXIT_ROLLBACK_ERROR)
+
+    summary = config.get('summary', {}).get('enabled') and aggregates.available()
+
+    # Month partitions of every year, with head year is rebuilt from scratch
+    partitions = {}
+    # Summary of every year
+    year_partials = {}
+    # Resources with uploaded file, they are ingested into DataStore by datapusher
+    pushed_resources = set()
+    for data, y, m, station, socket in month_year_iter(args.start_month, args.start_year, args.end_month, args.end_year):
+        filename = location + '/' + config['filename'] + str(y) + config['extension'] # backup/elektronabijecky_xxxx.csv
+        month = '%s-%02d' % (y, m)
 
-for data, y, m, counter in month_year_iter(args.start_month, args.start_year, args.end_month, args.end_year):
-    filename = location + '/' + config['filename'] + str(y) + config['extension'] # backup/elektronabijecky_xxxx.csv
-
-    if os.path.exists(filename):
-        append_write = 'a' # append if already exists
-    else:
-        append_write = 'w' # make a new file if not
-    try:
-        outfile = open(filename, append_write, newline='\n', encoding='utf-8')
-    except IOError:
-        logging.error('Could not open file for writing. Exiting...')
-        exit(EXIT_FILE_ERROR)
-    logging.debug('File opened')
-    writer = csv.writer(outfile)
-
-    if data != 'Err - empty table':
-        if not head_written:
-            writer.writerow(config['table_head'])
-            head_written = True
-        #print(' '.join(TABLE_HEAD))
-        for row in data:
-            writer.writerow(row)
-            #print(' '.join(data))
-        outfile.close()
-
-    if y != args.end_year:
-        months_in_year = 12
-    else:
-        months_in_year = args.end_month
-
-    # Ending loop after end_month iterations and all sockets proccessed
-    if m == months_in_year and counter == len(config['socket_dict']):
-        head_written = False
-
-        # Check if package exists
         try:
-            data={'id': config['package'] + str(y)}
-            headers={'Authorization': config['apikey']}
-            r = ckan_post_request(config['url_api'], 'package_show', data, headers, None)
-            data = r.json()
-        except:
-            logging.info('Dataset %s does not exists', config['package'] + str(y))
-
-        # dataset does not exists or is deleted, create one
-        if r == EXIT_REQUEST_ERROR or data['result']['state'] == 'deleted':
-            logging.info('Creating dataset %s', config['package'] + str(y))
-            data = {
-                'name': config['package'] + str(y),
-                'title': config['package_name'] + str(y),
-                'private': False,
-                'url': 'upload',  # Needed to pass validation,
-                'owner_org': config['owner_org']
-            }
-            headers = {'Authorization': config['apikey']}
-            r = ckan_post_request(config['url_api'], 'package_create', data, headers, None)
-
-            if r == EXIT_REQUEST_ERROR:
-                logging.error('Couldn\'t create dataset %s, exiting...', config['package'] + str(y))
-                exit(EXIT_REQUEST_ERROR)
-
-            data = r.json()
-
-        # we have id of package that will be updated
-        package_id = data['result']['id']
-
-        resource_id = ''
-        for resource in data['result']['resources']:
-            now = datetime.now()
-            if resource['name'] == config['package_name'] + str(now.year):
-                resource_id = resource['id']
-
-        path = os.path.join(filename)
-        extension = os.path.splitext(filename)[1][1:].upper()
-        resource_name = '{extension} file'.format(extension=extension)
-        if resource_id == '':
-            logging.info('Creating "{resource_name}" resource'.format(**locals()))
-            data = {
-                'package_id': package_id,
-                'name': config['package_name'] + str(y),
-                'format': extension,
-                'url': 'upload',  # Needed to pass validation
-            }
-            headers = {'Authorization': config['apikey']}
-            r = ckan_post_request(config['url_api'], 'resource_create', data, headers, filename)
-            if r == EXIT_REQUEST_ERROR:
-                exit(rollback(location, args.start_year, args.end_year))
-        else:
-            logging.info('Updating "{resource_name}" resource'.format(**locals()))
-            data = {
-                'id': resource_id,
-                'package_id': package_id,
-                'name': config['package_name'] + str(y),
-                'format': extension,
-                'url': 'upload',  # Needed to pass validation
-            }
-            headers = {'Authorization': config['apikey']}
-            r = ckan_post_request(config['url_api'], 'resource_update', data, headers, filename)
-            if r == EXIT_REQUEST_ERROR:
-                exit(rollback(location, args.start_year, args.end_year))
-
+            # Rerun of month replaces its partition, tables of other sockets are appended to it
+            if y not in partitions:
+                partitions[y] = Partitions(transaction, filename, config['table_head'], 1, 2, rebuild=args.head)
+            writer = partitions[y].open(month)
+        except IOError:
+            logging.error('Could not open file for writing. Exiting...')
+            exit(EXIT_FILE_ERROR)
+        logging.debug('File opened')
+
+        with metrics.stage('write'):
+            if data != 'Err - empty table':
+                for row in data:
+                    writer.writerow(row)
+                    #print(' '.join(data))
+            partitions[y].close(month, writer)
+
+        if summary:
+            # Days of socket imported for this month replace stored ones, other days of year are kept
+            with metrics.stage('summary'):
+                state = transaction.path(summary_filename(filename, '.json'), truncate=args.head)
+                year_partials[y] = update_summary(state, partitions[y], month, transform.iris[station, socket],
+                                                  data if data != 'Err - empty table' else [])
+
+    if session is not None:
+        session.close()
+
+    # Every touched year is uploaded once, years at once, any failure rolls all of them back.
+    # Summary without any session is published too, it replaces stale one.
+    def publish(year):
+        derived = [summary_resource(year, partitions[year].filename, year_partials[year])] if summary else []
+        return publisher.publish_year(year, partitions[year], args.publish, derived)
+
+    results = list(ordered_map(publish, list(partitions), config.get('upload_workers', 4)))
+    if any(pushed is None for pushed in results):
+        exit(rollback())
+    for pushed in results:
+        pushed_resources |= pushed
+
+    # Everything is uploaded, replace year files by new ones
+    with metrics.stage('commit'):
+        transaction.commit()
     logging.info('All datas successfully imported.')
 
-for year in range(args.start_year, args.end_year+1):
-    filename = config['filename'] + str(year) + config['extension']
+    # Files are already published, failed ingestion is only reported
+    if pushed_resources and config.get('datapusher', False):
+        with metrics.stage('datapusher'):
+            pushed = datapusher_push(config['url_api'], config['apikey'], pushed_resources,
+                                     timeout=config.get('datapusher_timeout', 600), session=ckan.session)
+        if not pushed:
+            logging.error('Some resources were not ingested into DataStore')
 
-    # Remove old backup, keep new one
-    try:
-        os.remove(filename + '.old')
-        logging.info('Removing old backups %s', filename)
-    except:
-        pass
+if __name__ == '__main__':
+    main()
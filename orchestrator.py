@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+"""
+Runs all import scripts in one process instead of separate runs from job.sh.
+Scripts are loaded as modules and run concurrently, each in its own thread,
+sharing HTTP connection pools. Monthly scripts import every month since the
+last successful run (only previous month on the first run), imported months
+are kept in state file.
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+import threading
+import importlib.util
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from common.publish import atomic_write
+
+EXIT_REQUEST_ERROR = 1
+EXIT_NOTHING_TO_UPLOAD = 4
+
+MONTHLY = ['elektronabijecky', 'teplota']
+PIPELINES = MONTHLY + ['uredni-deska']
+
+root = os.path.dirname(os.path.realpath(__file__))
+
+def load(name):
+    """Imports script of pipeline as module"""
+    path = os.path.join(root, name, name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def previous_month(year, month):
+    return (year, month - 1) if month > 1 else (year - 1, 12)
+
+def next_month(year, month):
+    return (year, month + 1) if month < 12 else (year + 1, 1)
+
+def window(last, now):
+    """
+        Returns first and last month to import, first one follows last imported
+        month, last one is previous month. Returns None if there is nothing new.
+    """
+    end = previous_month(now.year, now.month)
+    start = next_month(*last) if last else end
+    if start > end:
+        return None
+    return start, end
+
+def monthly_arguments(start, end):
+    (start_year, start_month), (end_year, end_month) = start, end
+    # Import starting in January rewrites year file, so it starts with table head
+    head = '--head' if start_month == 1 else '--no-head'
+    return ['-sy', str(start_year), '-sm', str(start_month),
+            '-ey', str(end_year), '-em', str(end_month), head]
+
+def run(module, name, argv):
+    """Runs main() of pipeline, returns its exit code"""
+    # Records of pipeline and its worker threads go into log file of pipeline
+    threading.current_thread().name = name
+    logging.info('Running %s %s', name, ' '.join(argv))
+    start = datetime.now()
+    try:
+        module.main(argv)
+        code = 0
+    except SystemExit as e:
+        code = e.code or 0
+    except Exception:
+        logging.exception('%s crashed', name)
+        code = EXIT_REQUEST_ERROR
+    logging.info('%s finished with %s in %s', name, code, datetime.now() - start)
+    return code
+
+def pipeline_logs(modules):
+    """
+        Adds log file of every pipeline with LOG_LEVEL of its script, records
+        are told apart by thread name
+    """
+    logger = logging.getLogger()
+    for name, module in modules.items():
+        handler = logging.FileHandler(os.path.join(root, name, name + '.log'))
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handler.setLevel(module.LOG_LEVEL)
+        handler.addFilter(lambda record, name=name: record.threadName.startswith(name))
+        logger.addHandler(handler)
+        # Root logger lets through records of the most verbose pipeline, handlers filter the rest
+        logger.setLevel(min(logger.level, module.LOG_LEVEL))
+
+def load_state(filename):
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(filename, state):
+    data = json.dumps(state, indent=1).encode('utf-8')
+    atomic_write(filename, lambda f: f.write(data))
+
+parser = argparse.ArgumentParser(description='Run all imports into CKAN')
+parser.add_argument('pipelines', nargs='*', default=PIPELINES, help='scripts to run (default: all)')
+parser.add_argument('--no-catch-up', action='store_true', help='import only previous month, even if some runs were missed')
+args = parser.parse_args()
+
+logging.basicConfig(filename=root + '/orchestrator.log', level=logging.INFO,
+                    format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+# orchestrator.log keeps INFO when root logger is lowered for pipelines
+for handler in logging.getLogger().handlers:
+    handler.setLevel(logging.INFO)
+
+state_file = root + '/orchestrator.json'
+state = load_state(state_file)
+now = datetime.now()
+
+jobs = {}
+for name in args.pipelines:
+    if name not in PIPELINES:
+        parser.error('unknown pipeline ' + name)
+    if name in MONTHLY:
+        months = window(None if args.no_catch_up else state.get(name), now)
+        if months is None:
+            logging.info('%s is up to date', name)
+            continue
+        jobs[name] = months, monthly_arguments(*months)
+    else:
+        jobs[name] = None, ['--discover']
+
+# Modules are imported before threads are started
+modules = {name: load(name) for name in jobs}
+pipeline_logs(modules)
+
+failed = []
+with ThreadPoolExecutor(max_workers=len(jobs) or 1) as executor:
+    futures = {name: executor.submit(run, modules[name], name, argv) for name, (months, argv) in jobs.items()}
+    for name, future in futures.items():
+        code = future.result()
+        months = jobs[name][0]
+        if code not in (0, EXIT_NOTHING_TO_UPLOAD):
+            failed.append(name)
+        elif months is not None:
+            state[name] = list(months[1])
+            save_state(state_file, state)
+
+if failed:
+    logging.error('Failed pipelines: %s', ', '.join(failed))
+    sys.exit(EXIT_REQUEST_ERROR)
+logging.info('All pipelines finished.')
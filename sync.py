@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""
+Reconciles backup/ directories of scripts with CKAN, only files whose
+content differs from what CKAN already has are uploaded
+"""
+import os
+import re
+import glob
+import argparse
+import logging
+import toml
+
+from common.manifest import Manifest, file_sha256
+from common import ckan as ckan_client
+
+EXIT_REQUEST_ERROR = 1
+
+PIPELINES = ['elektronabijecky', 'teplota', 'uredni-deska']
+
+def sync_file(config, ckan, manifest, filename, suffix, dry_run):
+    """Uploads file into resource named by suffix (year or date) if it differs"""
+    package = config['package'] + suffix
+    name = config['package_name'] + suffix
+    sha256 = file_sha256(filename)
+
+    # Catalog of scripts is refreshed, CKAN is compared as it is now
+    result = ckan.package(package, fresh=True)
+    resource = None
+    if result is not None:
+        resource = ckan.resource(result, name)
+        if resource and manifest.unchanged(filename, sha256, resource['id'], resource['hash']):
+            logging.debug('%s is unchanged', filename)
+            return True
+
+    logging.info('%s differs from %s', filename, package)
+    if dry_run:
+        return True
+
+    if result is None:
+        data = {
+            'name': package,
+            'title': name,
+            'private': False,
+            'url': 'upload',  # Needed to pass validation,
+            'owner_org': config['owner_org']
+        }
+        result = ckan.create_package(data)
+        if result is None:
+            logging.error('Couldn\'t create dataset %s', package)
+            return False
+
+    data = {
+        'package_id': result['id'],
+        'name': name,
+        'format': config['extension'][1:].upper(),
+        'url': 'upload',  # Needed to pass validation
+        'hash': sha256,
+    }
+    if resource:
+        data['id'] = resource['id']
+        resource = ckan.update_resource(result, data, filename)
+    else:
+        resource = ckan.create_resource(result, data, filename)
+    if resource is None:
+        logging.error('Upload of %s failed', filename)
+        return False
+
+    manifest.record(filename, sha256, resource['id'])
+    return True
+
+def sync(location, dry_run):
+    """Synchronizes backup directory of one script, returns number of failures"""
+    try:
+        config = toml.load(location + '/config.toml')
+    except (OSError, toml.TomlDecodeError):
+        logging.error('Config file of %s is missing', location)
+        return 1
+
+    manifest = Manifest(location + '/' + config.get('manifest', 'backup/.manifest.json'))
+    ckan = ckan_client.from_config(location, config)
+    prefix = location + '/' + config['filename']
+    failures = 0
+    for filename in sorted(glob.glob(prefix + '*' + config['extension'])):
+        suffix = filename[len(prefix):-len(config['extension'])]
+        # Summaries next to year files are published by the scripts themselves
+        if not re.fullmatch(r'\d{4}(-\d\d-\d\d)?', suffix):
+            continue
+        if not sync_file(config, ckan, manifest, filename, suffix, dry_run):
+            failures += 1
+    return failures
+
+parser = argparse.ArgumentParser(description='Upload backup files that differ from CKAN')
+parser.add_argument('pipelines', nargs='*', default=PIPELINES, help='scripts to synchronize (default: all)')
+parser.add_argument('-n', '--dry-run', action='store_true', help='only report files that differ')
+args = parser.parse_args()
+
+root = os.path.dirname(os.path.realpath(__file__))
+logging.basicConfig(filename=root + '/sync.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+failures = 0
+for pipeline in args.pipelines:
+    logging.info('Synchronizing %s', pipeline)
+    failures += sync(root + '/' + pipeline, args.dry_run)
+
+if failures:
+    logging.error('%s files failed to synchronize', failures)
+    exit(EXIT_REQUEST_ERROR)
+logging.info('All files synchronized.')
@@ -4,6 +4,7 @@ This script is used for automatic publication of temperature datas
 of Žďár nad Sázavou city into CKAN
 """
 import os
+import sys
 import csv
 import argparse
 from datetime import datetime
@@ -11,7 +12,19 @@ import logging
 import requests
 from bs4 import BeautifulSoup
 import toml
-from shutil import copyfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from common.pool import ordered_map
+from common.manifest import Manifest
+from common import cache as response_cache
+from common import connections
+from common.ckan import datapusher_push
+from common import ckan as ckan_client
+from common.datasets import Publisher
+from common.publish import Transaction
+from common.partitions import Partitions
+from common import metrics as run_metrics
+from common import aggregates
 
 EXIT_REQUEST_ERROR = 1
 EXIT_ROLLBACK_SUCCESS = 2
@@ -20,331 +33,364 @@ EXIT_MISSING_CONFIG = 5
 EXIT_ARGUMENT_ERROR = 6
 EXIT_FILE_ERROR = 7
 
+# Level of teplota.log, orchestrator logs the script with it too
+LOG_LEVEL = logging.INFO
+
+# Session with connection pool shared by whole run
+pooled_session = None
+# Timings and counters of run, disabled unless metrics_dir is configured
+metrics = run_metrics.NULL
+
+def valid_month(response):
+    """Months answered with Invalid input (or nothing) are never cached"""
+    head = next((line for line in response.iter_lines() if line), None)
+    return head is not None and head != b'Invalid input'
+
+def request_month(session, url, year, month):
+    now = datetime.now()
+    try:
+        # Closed months never change, they are served from cache without request.
+        # Body is streamed, it is read line by line by clean_data.
+        request = cache.fetch(
+            session, 'GET',
+            url + '&R=' +
+            str(year) + '&M=' +
+            str(month),
+            immutable=(year, month) < (now.year, now.month),
+            valid=valid_month,
+            stream=True
+        )
+        request.raise_for_status()
+    # Transient errors were already retried by session, these are permanent
+    except requests.exceptions.ConnectionError as e:
+        logging.error(e)
+        logging.error('Request for retrieving table data failed. Exiting...')
+        exit(EXIT_REQUEST_ERROR)
+    except requests.exceptions.HTTPError as e:
+        logging.error(e)
+        logging.error('Request for retrieving table data failed. Exiting...')
+        exit(EXIT_REQUEST_ERROR)
+    except requests.exceptions.RequestException as e:
+        logging.error(e)
+        logging.error('Request for retrieving table data failed. Exiting...')
+        exit(EXIT_REQUEST_ERROR)
+
+    return request
+
 def get_data(url, year, month):
     """Scrape data from web"""
-    with requests.Session() as session:
-        try:
-            request = session.get(
-                url + '&R=' +
-                str(year) + '&M=' +
-                str(month)
-            )
-        except requests.exceptions.ConnectionError as e:
-            logging.error(e)
-            logging.error('Request for retrieving table data failed. Exiting...')
-            exit(EXIT_REQUEST_ERROR)
-        except requests.exceptions.HTTPError as e:
-            logging.error(e)
-            logging.error('Request for retrieving table data failed. Exiting...')
-            exit(EXIT_REQUEST_ERROR)
-        except requests.exceptions.RequestException as e:
-            logging.error(e)
-            logging.error('Request for retrieving table data failed. Exiting...')
-            exit(EXIT_REQUEST_ERROR)
-
-        return request
+    return request_month(pooled_session, url, year, month)
 
 def clean_data(raw_data):
-    """ Removes data that are not suitable for publishing """
-
-    list_of_rows = list(filter(bool, raw_data.content.decode('utf-8').splitlines()))
+    """
+        Removes data that are not suitable for publishing. Returns generator
+        of (time, temp1, temp2) rows read line by line from response.
+    """
+    lines = (line.decode('utf-8') for line in raw_data.iter_lines() if line)
 
-    if list_of_rows == ['Invalid input']:
+    # Removes table header
+    head = next(lines, None)
+    if head is None or head == 'Invalid input':
         logging.info('Invalid input')
+        raw_data.close()
         return 1
-    list_of_rows = [row.split(';') for row in list_of_rows]
-    for row in list_of_rows:
-        row[0] = row[0].replace(' ', 'T', 1)
-        del row[3]
 
-    # At this point we have double dimensional array, [[time, temp1, temp2], ...]
-    # Removes table header
-    del list_of_rows[0]
+    return clean_rows(lines)
 
-    return list_of_rows
+def clean_rows(lines):
+    for line in lines:
+        row = line.split(';')
+        yield row[0].replace(' ', 'T', 1), row[1], row[2]
 
-def prepare_data(list_of_rows):
+def prepare_data(rows):
     """
         Prepares data for publishing and neccessary data to conform Open Normal Form of datas.
+        Rows are transformed one by one as they are written into file.
     """
-
-    prepared_data = []
-    index = 0
-    for row in list_of_rows:
-        prepared_data.append([row[0],config['senzor1-iri'], config['senzor1-name'], row[1], '°C', config['senzor1-long'], config['senzor1-lat']])
-        if row[2]:
-            prepared_data.append([row[0], config['senzor2-iri'], config['senzor2-name'], row[2], '°C', config['senzor2-long'], config['senzor2-lat']])
-    return prepared_data
+    senzor1 = (config['senzor1-iri'], config['senzor1-name'])
+    senzor1_position = (config['senzor1-long'], config['senzor1-lat'])
+    senzor2 = (config['senzor2-iri'], config['senzor2-name'])
+    senzor2_position = (config['senzor2-long'], config['senzor2-lat'])
+    for time, temp1, temp2 in rows:
+        yield (time,) + senzor1 + (temp1, '°C') + senzor1_position
+        if temp2:
+            yield (time,) + senzor2 + (temp2, '°C') + senzor2_position
+
+def download_month(ym):
+    """Downloads one month, runs in worker thread in backfill mode"""
+    y, m = divmod(ym, 12)
+    logging.info('Processing %s/%s', y, m + 1)
+    with metrics.stage('fetch'):
+        raw_table = get_data(config['request_url'], y, m + 1)
+        if workers > 1 and not isinstance(raw_table.raw, response_cache.CachedBody):
+            # Worker has to download whole body, otherwise it is downloaded only
+            # when it is processed and months would not be fetched concurrently
+            raw_table.content
+    return y, m + 1, raw_table
 
 def month_year_iter(start_month, start_year, end_month, end_year):
     ym_start = 12*start_year + start_month - 1
     ym_end = 12*end_year + end_month - 1
-    for ym in range(ym_start, ym_end+1):
-        y, m = divmod(ym, 12)
-        logging.info('Processing %s/%s', y, m + 1)
-        raw_table = get_data(config['request_url'], y, m + 1)
-
-        # list_of_rows contains prepared unprocessed data in list,
-        # where each item is one row [[row], [row], [row]...]
-        list_of_rows = clean_data(raw_table)
-        logging.info('Data for %s/%s cleaned', y, m + 1)
+    # In backfill mode months are downloaded concurrently, but processed in order
+    for y, m, raw_table in ordered_map(download_month, range(ym_start, ym_end+1), workers):
+        # rows are generated lazily while data are written into file
+        rows = clean_data(raw_table)
+        logging.info('Data for %s/%s cleaned', y, m)
 
         # if table is empty, return empty list
-        if list_of_rows == 1:
-            yield 'Err - empty table', y, m+1
+        if rows == 1:
+            yield 'Err - empty table', y, m
         else:
             # data contains final form of datas, prepared to be written into file
-            data = prepare_data(list_of_rows)
-            logging.info('Data for %s/%s prepared', y, m + 1)
+            data = prepare_data(rows)
+            logging.info('Data for %s/%s prepared', y, m)
 
-            yield data, y, m+1
+            yield data, y, m
 
-def ckan_post_request(url, action, data, headers, filename):
-    """
-        Wrapper around request call to provide neccessary parameters.
-    """
-    if filename:
-        files=[('upload', open(filename, 'rb'))]
-    else:
-        files=None
-    try:
-        r = requests.post(url + action,
-                          data=data,
-                          headers=headers,
-                          files=files)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        logging.error(r.text)
-        logging.error(e)
-        return EXIT_REQUEST_ERROR
-    except requests.exceptions.RequestException as e:
-        logging.error(r.text)
-        logging.error(e)
-        return EXIT_REQUEST_ERROR
-
-    if action in ['package_show', 'package_create']:
-        return r
-    else:
-        return 0
-
-def rollback(location, start_year, end_year):
-    rollback_error = False
-    for year in range(start_year, end_year+1):
-        logging.error('Rollback of year %s in progress', year)
-        filename = location + '/' + config['filename'] + str(year) + config['extension']
-
-        try:
-            # Remove corrupted files
-            os.remove(filename)
-
-            # Restore backed up files
-            copyfile(filename + '.old', filename)
-
-            # Remove old back ups
-            os.remove(filename + ".old")
-        except:
-            pass
-
-        extension = os.path.splitext(filename)[1][1:].upper()
-        logging.info('Creating "{resource_name}" resource'.format(**locals()))
-        data = {
-            'package_id': config['package'],
-            'name': year,
-            'format': extension,
-            'url': 'upload',  # Needed to pass validation
-        }
-        headers = {'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'resource_create', data, headers, filename)
-
-        if r == EXIT_REQUEST_ERROR:
-            rollback_error = True
-            logging.critical('FATAL ERROR: Rollback for year %s failed, trying to rollback the rest', year)
-
-    if rollback_error:
-        return EXIT_ROLLBACK_ERROR
-
-    return EXIT_ROLLBACK_SUCCESS
-
-parser = argparse.ArgumentParser(description='Import Žďár nad Sázavou temperature datas into CKAN')
+# Rows aggregated at once, month is folded into aggregates chunk by chunk
+AGGREGATES_CHUNK = 10000
 
-parser.add_argument('-sy','--start-year', action='store', type=int, required='True', help='start year of import')
-parser.add_argument('-sm','--start-month', action='store', type=int, required='True', help='start month of import')
-parser.add_argument('-ey', '--end-year', action='store', type=int, required='True', help='end year of import')
-parser.add_argument('-em', '--end-month', action='store', type=int, required='True',help='end month of import')
+AGGREGATES_HEAD = ['obdobi', 'datum', 'cidlo', 'nazev_cidla', 'pocet_mereni', 'minimum', 'maximum', 'prumer',
+                   'jednotka']
 
-group_head = parser.add_mutually_exclusive_group(required=True)
-group_head.add_argument('--head', action='store_true', help='include head of table')
-group_head.add_argument('--no-head', action='store_true', help='do not include head of table')
+def aggregates_filename(filename, extension):
+    """Returns name of aggregates file kept next to year file"""
+    return os.path.splitext(filename)[0] + config['aggregates'].get('suffix', '_souhrn') + extension
 
-args = parser.parse_args()
+def daily_partials(rows):
+    """
+        Computes partial aggregates [count, sum, min, max] of temperature of
+        every sensor and day of rows, keyed by 'sensor IRI|YYYY-MM-DD'.
+    """
+    table = aggregates.table(rows)
+    # Measurement of sensor may be missing
+    table = table[table[:, 3] != '']
+    iris, sensors = aggregates.encode(table[:, 1])
+    (sensors, days), counts, sums, minimums, maximums = aggregates.reduce_groups(
+        [sensors, aggregates.days(table[:, 0])], table[:, 3].astype(float))
+    return {iris[sensor] + '|' + aggregates.day_string(day): [int(count), float(total), float(low), float(high)]
+            for sensor, day, count, total, low, high in zip(sensors, days, counts, sums, minimums, maximums)}
+
+def stored_aggregates(storage):
+    """Computes aggregates state of year from all its stored month partitions, rows are folded in chunks"""
+    partials = {}
+    for month in storage.entries['partitions']:
+        month_partials = {}
+        chunk = []
+        for row in storage.read([month]):
+            chunk.append(row)
+            if len(chunk) == AGGREGATES_CHUNK:
+                aggregates.fold(month_partials, daily_partials(chunk))
+                chunk = []
+        if chunk:
+            aggregates.fold(month_partials, daily_partials(chunk))
+        for group, partial in month_partials.items():
+            partials[month + '|' + group] = partial
+    return partials
+
+def write_aggregates(path, partials):
+    """
+        Writes daily and monthly aggregates of every sensor into CSV file,
+        partials are keyed by 'imported month|sensor IRI|YYYY-MM-DD'
+    """
+    names = {config[senzor + '-iri']: config[senzor + '-name'] for senzor in ('senzor1', 'senzor2')}
+    daily = aggregates.rollup(partials, lambda group: group.split('|', 1)[1])
+    # 'IRI|YYYY-MM-DD' -> 'IRI|YYYY-MM'
+    monthly = aggregates.rollup(daily, lambda group: group[:-3])
+    with open(path, 'w', newline='\n', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(AGGREGATES_HEAD)
+        for period, groups in (('den', daily), ('mesic', monthly)):
+            for group in sorted(groups):
+                iri, date = group.rsplit('|', 1)
+                count, total, low, high = groups[group]
+                writer.writerow([period, date, iri, names.get(iri, ''), count, low, high, round(total / count, 2), '°C'])
+
+def aggregates_resource(year, year_filename, partials):
+    """Returns aggregates of year as (stage, name, filename, write) of file derived from year file"""
+    return ('aggregates', config['package_name'] + str(year) + ' (denní a měsíční souhrn)',
+            aggregates_filename(year_filename, '.csv'), lambda path: write_aggregates(path, partials))
+
+def rollback():
+    if publisher.rollback():
+        return EXIT_ROLLBACK_SUCCESS
+
+    return EXIT_ROLLBACK_ERROR
+
+def main(argv=None):
+    """Imports temperature data of months given by arguments into CKAN, metrics are written at the end"""
+    code = EXIT_REQUEST_ERROR
+    try:
+        run(argv)
+        code = 0
+    except SystemExit as e:
+        code = e.code or 0
+        raise
+    finally:
+        metrics.finish(code if isinstance(code, int) else EXIT_REQUEST_ERROR)
 
-dirname = os.path.realpath(__file__)
-location = dirname.rsplit('/',1)[0]
-filename = location + '/config.toml'
+def run(argv):
+    global config, cache, workers, pooled_session, transaction, publisher, metrics
 
-logging.basicConfig(filename=location + "/teplota.log", level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Import Žďár nad Sázavou temperature datas into CKAN')
 
-try:
-    config = toml.load(filename)
-except:
-    logging.error("Config file is missing. Exiting...")
-    exit(EXIT_MISSING_CONFIG)
+    parser.add_argument('-sy','--start-year', action='store', type=int, required='True', help='start year of import')
+    parser.add_argument('-sm','--start-month', action='store', type=int, required='True', help='start month of import')
+    parser.add_argument('-ey', '--end-year', action='store', type=int, required='True', help='end year of import')
+    parser.add_argument('-em', '--end-month', action='store', type=int, required='True',help='end month of import')
 
-if ((len(str(args.start_year)) != 4) or (len(str(args.end_year)) != 4)):
-    logging.error('Given year does not has 4 digits. Exiting...')
-    exit(EXIT_ARGUMENT_ERROR)
+    group_head = parser.add_mutually_exclusive_group(required=True)
+    group_head.add_argument('--head', action='store_true', help='include head of table')
+    group_head.add_argument('--no-head', action='store_true', help='do not include head of table')
 
-if ((len(str(args.start_month)) > 2) or (len(str(args.end_month)) > 2) and
-    (len(str(args.start_month)) <= 0) or (len(str(args.end_month)) <= 0)):
-    logging.error('Given month does not has 2 digits. Exiting...')
-    exit(EXIT_ARGUMENT_ERROR)
+    parser.add_argument('--publish', action='store', choices=['file', 'datastore', 'both'], default='file',
+                        help='upload whole year file, upsert only new rows into DataStore or both (default: file)')
 
-if ((args.start_year <= 2005) or ((args.start_year <= 2006 and args.start_month < 7))):
-    logging.error('There are no data to be processed before 2006/7. Exiting...')
-    exit(EXIT_ARGUMENT_ERROR)
+    parser.add_argument('--no-cache', action='store_true', help='do not use cache of downloaded data')
+    parser.add_argument('-w', '--workers', action='store', type=int, help='backfill mode, number of months downloaded at once (default from config)')
 
-if args.start_year > args.end_year:
-    logging.error('Starting month/year has to be smaller that ending month/year. Exiting...')
-    exit(EXIT_ARGUMENT_ERROR)
+    args = parser.parse_args(argv)
 
-logging.debug('Arguments parsed.')
-if args.head:
-    head_written = False
-if args.no_head:
-    head_written = True
+    dirname = os.path.realpath(__file__)
+    location = dirname.rsplit('/',1)[0]
+    filename = location + '/config.toml'
 
-for year in range(args.start_year, args.end_year+1):
-    filename = location + '/'  + config['filename'] + str(year) + config['extension']
+    logging.basicConfig(filename=location + "/teplota.log", level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 
     try:
-        # Create backup of file being uploaded
-        copyfile(filename, filename + '.old')
-        logging.info('Backing up %s.old', filename)
-
-        if args.head:
-            os.remove(filename)
-            logging.info('Removed %s', filename)
+        config = toml.load(filename)
     except:
-        logging.info('Nothing to backup')
-
-package_updated_id = set([])
-for data, y, m in month_year_iter(args.start_month, args.start_year, args.end_month, args.end_year):
-    filename = location + '/' + config['filename'] + str(y) + config['extension'] # backup/teplota_xxxx.csv
-
-    if os.path.exists(filename):
-        append_write = 'a' # append if already exists
-        logging.debug('Appending to existing file')
-    else:
-        append_write = 'w' # make a new file if not
-        logging.debug('Writing to new file')
-    try:
-        outfile = open(filename, append_write, newline='\n', encoding='utf-8')
-    except IOError:
-        logging.error('Could not open file for writing. Exiting...')
-        exit(EXIT_FILE_ERROR)
-    logging.debug('File opened')
-    writer = csv.writer(outfile)
-
-    if data != 'Err - empty table':
-        if not head_written:
-            writer.writerow(config['table_head'])
-            head_written = True
-        #print(' '.join(TABLE_HEAD))
-        for row in data:
-            writer.writerow(row)
-            #print(' '.join(data))
-        outfile.close()
-
-    if y != args.end_year:
-        months_in_year = 12
-    else:
-        months_in_year = args.end_month
-
-    # Reset head_written at the end of year
-    if m == months_in_year:
-        head_written = False
-
-    # Check if package exists
-    try:
-        data={'id': config['package'] + str(y)}
-        headers={'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'package_show', data, headers, None
-)
-        data = r.json()
-
-    except:
-        logging.info('Dataset %s does not exists', config['package'] + str(y))
-
-    # dataset does not exists or is deleted, create one
-    if r == EXIT_REQUEST_ERROR or data['result']['state'] == 'deleted':
-        logging.info('Creating dataset %s', config['package'] + str(y))
-        data = {
-            'name': config['package'] + str(y),
-            'title': config['package_name'] + str(y),
-            'private': False,
-            'url': 'upload',  # Needed to pass validation,
-            'owner_org': config['owner_org']
-        }
-        headers = {'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'package_create', data, headers, None)
-
-        if r == EXIT_REQUEST_ERROR:
-            logging.error('Couldn\'t create dataset %s, exiting...', config['package'] + str(y))
-            exit(EXIT_REQUEST_ERROR)
-
-        data = r.json()
-
-    # we have id of package that will be updated
-    package_id = data['result']['id']
-    package_updated_id.add(package_id)
-
-    resource_id = ''
-    for resource in data['result']['resources']:
-        if resource['name'] == config['package_name'] + str(y):
-            resource_id = resource['id']
-
-    path = os.path.join(filename)
-    extension = os.path.splitext(filename)[1][1:].upper()
-    resource_name = '{extension} file'.format(extension=extension)
-    if resource_id == '':
-        logging.info('Creating "{resource_name}" resource'.format(**locals()))
-        data = {
-            'package_id': package_id,
-            'name': config['package_name'] + str(y),
-            'format': extension,
-            'url': 'upload',  # Needed to pass validation
-        }
-        headers = {'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'resource_create', data, headers, filename)
-        if r == EXIT_REQUEST_ERROR:
-            exit(rollback(location, args.start_year, args.end_year))
-    else:
-        logging.info('Updating "{resource_name}" resource'.format(**locals()))
-        data = {
-            'id': resource_id,
-            'package_id': package_id,
-            'name': config['package_name'] + str(y),
-            'format': extension,
-            'url': 'upload',  # Needed to pass validation
-        }
-        headers = {'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'resource_update', data, headers, filename)
-        if r == EXIT_REQUEST_ERROR:
-            exit(rollback(location, args.start_year, args.end_year))
+        logging.error("Config file is missing. Exiting...")
+        exit(EXIT_MISSING_CONFIG)
+
+    # Measurements of both sensors would collide in DataStore and aggregates
+    if config['senzor1-iri'] == config['senzor2-iri']:
+        logging.error('senzor1-iri and senzor2-iri have to differ. Exiting...')
+        exit(EXIT_MISSING_CONFIG)
+
+    if ((len(str(args.start_year)) != 4) or (len(str(args.end_year)) != 4)):
+        logging.error('Given year does not has 4 digits. Exiting...')
+        exit(EXIT_ARGUMENT_ERROR)
+
+    if ((len(str(args.start_month)) > 2) or (len(str(args.end_month)) > 2) and
+        (len(str(args.start_month)) <= 0) or (len(str(args.end_month)) <= 0)):
+        logging.error('Given month does not has 2 digits. Exiting...')
+        exit(EXIT_ARGUMENT_ERROR)
+
+    if ((args.start_year <= 2005) or ((args.start_year <= 2006 and args.start_month < 7))):
+        logging.error('There are no data to be processed before 2006/7. Exiting...')
+        exit(EXIT_ARGUMENT_ERROR)
+
+    if args.start_year > args.end_year:
+        logging.error('Starting month/year has to be smaller that ending month/year. Exiting...')
+        exit(EXIT_ARGUMENT_ERROR)
+
+    metrics = run_metrics.from_config('teplota', location, config)
+    cache = response_cache.from_config(location, config, not args.no_cache)
+    workers = args.workers or config.get('workers', 1)
+    if workers > 1:
+        logging.info('Backfill mode, downloading %s months at once', workers)
+    # Keep-alive connections come from pools shared with other pipelines
+    # Source is rate limited and failed requests are retried
+    pooled_session = metrics.instrument(connections.session(config.get('retries', connections.RETRIES),
+                                                            config.get('rate_limit')))
+
+    logging.debug('Arguments parsed.')
+
+    # Year files are written into temporary files renamed over them at the end of run
+    transaction = Transaction(location + '/' + config.get('journal', 'backup/.journal.json'))
+    ckan = ckan_client.from_config(location, config, metrics)
+    publisher = Publisher(config, ckan, Manifest(location + '/' + config.get('manifest', 'backup/.manifest.json')),
+                          transaction, metrics)
+    if transaction.pending():
+        logging.warning('Previous run did not finish, rolling it back')
+        if not publisher.rollback():
+            exit(EXIT_ROLLBACK_ERROR)
+
+    aggregate = config.get('aggregates', {}).get('enabled') and aggregates.available()
+
+    # Month partitions of every year, with head year is rebuilt from scratch
+    partitions = {}
+    # Aggregates of every year
+    year_partials = {}
+    # Resources with uploaded file, they are ingested into DataStore by datapusher
+    pushed_resources = set()
+    for data, y, m in month_year_iter(args.start_month, args.start_year, args.end_month, args.end_year):
+        filename = location + '/' + config['filename'] + str(y) + config['extension'] # backup/teplota_xxxx.csv
+        month = '%s-%02d' % (y, m)
 
+        try:
+            # Rerun of month replaces its partition instead of appending rows again
+            if y not in partitions:
+                partitions[y] = Partitions(transaction, filename, config['table_head'], rebuild=args.head)
+            writer = partitions[y].open(month)
+        except IOError:
+            logging.error('Could not open file for writing. Exiting...')
+            exit(EXIT_FILE_ERROR)
+        logging.debug('File opened')
+
+        # Aggregates of month, rows are folded into them in chunks
+        month_partials = {}
+        chunk = []
+
+        # Rows are cleaned and prepared lazily while they are written
+        with metrics.stage('process'):
+            rows = 0
+            if data != 'Err - empty table':
+                for row in data:
+                    writer.writerow(row)
+                    rows += 1
+                    if aggregate:
+                        chunk.append(row)
+                        if len(chunk) == AGGREGATES_CHUNK:
+                            aggregates.fold(month_partials, daily_partials(chunk))
+                            chunk = []
+                    #print(' '.join(data))
+            partitions[y].close(month, writer)
+        metrics.count('rows_total', rows)
+
+        if aggregate:
+            # Days imported for this month replace stored ones, days of sensors missing
+            # in rerun are removed, other months of year are kept. State which is missing
+            # or empty is rebuilt from stored partitions first.
+            with metrics.stage('aggregates'):
+                if chunk:
+                    aggregates.fold(month_partials, daily_partials(chunk))
+                state = transaction.path(aggregates_filename(filename, '.json'), truncate=args.head)
+                partials = aggregates.load(state)
+                if not partials:
+                    partials = stored_aggregates(partitions[y])
+                aggregates.replace(partials, month + '|',
+                                   {month + '|' + group: partial for group, partial in month_partials.items()})
+                aggregates.save(state, partials)
+            year_partials[y] = partials
+
+    # Every touched year is uploaded once, years at once, any failure rolls all of them back.
+    # Aggregates without any measurement are published too, they replace stale ones.
+    def publish(year):
+        derived = [aggregates_resource(year, partitions[year].filename, year_partials[year])] if aggregate else []
+        return publisher.publish_year(year, partitions[year], args.publish, derived)
+
+    results = list(ordered_map(publish, list(partitions), config.get('upload_workers', 4)))
+    if any(pushed is None for pushed in results):
+        exit(rollback())
+    for pushed in results:
+        pushed_resources |= pushed
+
+    # Everything is uploaded, replace year files by new ones
+    with metrics.stage('commit'):
+        transaction.commit()
     logging.info('All datas successfully imported.')
 
-for year in range(args.start_year, args.end_year+1):
-    filename = location + '/'  + config['filename'] + str(year) + config['extension']
-    # Remove old backup, keep new one
-    try:
-        os.remove(filename + '.old')
-        logging.info('Removing old backups %s', filename)
-    except:
-        pass
+    pooled_session.close()
 
-# Write to file ids of updated packages, it will be passed to paster to update DataStore
-with open('../ids.txt','a') as f:
-    for id in package_updated_id:
-        f.write(id + '\n')
+    # Files are already published, failed ingestion is only reported
+    if pushed_resources and config.get('datapusher', True):
+        with metrics.stage('datapusher'):
+            pushed = datapusher_push(config['url_api'], config['apikey'], pushed_resources,
+                                     timeout=config.get('datapusher_timeout', 600), session=ckan.session)
+        if not pushed:
+            logging.error('Some resources were not ingested into DataStore')
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Rerun of one month keeps summary of other months of year, also when summary
+state is missing and has to be rebuilt from stored partitions
+"""
+import os
+import sys
+import importlib.util
+
+import pytest
+
+pytest.importorskip('numpy')
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root)
+from common.publish import Transaction
+from common.partitions import Partitions
+
+spec = importlib.util.spec_from_file_location('elektronabijecky',
+                                              os.path.join(root, 'elektronabijecky', 'elektronabijecky.py'))
+elektronabijecky = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(elektronabijecky)
+
+HEAD = ['nabijeci_stanice', 'nabijeni_interval_zacatek_datum_a_cas', 'nabijeni_interval_konec_datum_a_cas',
+        'spotreba_hodnota', 'spotreba_jednotka']
+IRI = 'https://data.zdarns.cz/zdroj/stojan-1'
+MONTHS = ['2019-01', '2019-02', '2019-03']
+
+def rows(month):
+    return [(IRI, '%s-%02dT10:00:00' % (month, day), '%s-%02dT11:30:00' % (month, day), '%d.500' % day, 'KWH')
+            for day in range(1, 11)]
+
+def import_months(directory, months, rebuild=False):
+    """Imports months like run of script does, returns summary CSV of year"""
+    transaction = Transaction(os.path.join(directory, '.journal.json'))
+    storage = Partitions(transaction, os.path.join(directory, 'elektronabijecky_2019.csv'), HEAD, 1, 2,
+                         rebuild=rebuild)
+    state = transaction.path(os.path.join(directory, 'elektronabijecky_2019_souhrn.json'), truncate=rebuild)
+    for month in months:
+        writer = storage.open(month)
+        for row in rows(month):
+            writer.writerow(row)
+        storage.close(month, writer)
+        partials = elektronabijecky.update_summary(state, storage, month, IRI, rows(month))
+    storage.assemble()
+    summary = transaction.path(os.path.join(directory, 'elektronabijecky_2019_souhrn.csv'), truncate=True)
+    elektronabijecky.write_summary(summary, partials)
+    transaction.commit()
+    with open(os.path.join(directory, 'elektronabijecky_2019_souhrn.csv'), encoding='utf-8') as f:
+        return f.read()
+
+def yearly(summary):
+    return [line for line in summary.splitlines() if line.startswith('rok,')]
+
+def test_rerun_keeps_other_months(tmp_path):
+    full = import_months(str(tmp_path), MONTHS, rebuild=True)
+    assert yearly(full) == ['rok,2019,%s,30,0,180.0,45.0,0.0051' % IRI]
+
+    assert import_months(str(tmp_path), ['2019-02']) == full
+
+def test_missing_state_is_rebuilt_from_partitions(tmp_path):
+    full = import_months(str(tmp_path), MONTHS, rebuild=True)
+    os.remove(os.path.join(str(tmp_path), 'elektronabijecky_2019_souhrn.json'))
+
+    assert import_months(str(tmp_path), ['2019-02']) == full
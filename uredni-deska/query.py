@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+"""
+Queries local SQLite index of City Council's voting archive kept by
+uredni-deska.py, results are printed as tab separated rows
+"""
+import os
+import sys
+import glob
+import argparse
+from collections import Counter
+import toml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from common import voting
+from common.voting_index import VotingIndex
+
+EXIT_NOT_FOUND = 1
+EXIT_MISSING_CONFIG = 5
+
+def print_rows(rows):
+    for row in rows:
+        print('\t'.join(str(value) for value in row))
+
+def reindex(index, args):
+    filenames = sorted(glob.glob(location + '/' + config['filename'] + '*' + config['extension']))
+    indexed = index.sync(filenames)
+    print('%s of %s sessions indexed, others unchanged' % (indexed, len(filenames)))
+
+def members(index, args):
+    print_rows((name,) for name in index.find_members(args.pattern or ''))
+
+def member(index, args):
+    names = index.find_members(args.name)
+    if args.name in names:
+        names = [args.name]
+    if not names:
+        print('No member matches %s' % args.name, file=sys.stderr)
+        exit(EXIT_NOT_FOUND)
+    for name in names:
+        rows = index.member_votes(name, args.since, args.until, args.vote)
+        if not args.summary:
+            print_rows(rows)
+        totals = Counter(row[-1] for row in rows)
+        print('# %s: %s' % (name, ', '.join('%s %s' % (vote, totals[vote]) for vote in voting.VOTES if totals[vote])),
+              file=sys.stderr if not args.summary else sys.stdout)
+
+def resolution(index, args):
+    result = index.resolution(args.id)
+    if result is None:
+        print('Resolution %s is not indexed' % args.id, file=sys.stderr)
+        exit(EXIT_NOT_FOUND)
+    (date, item, text), votes = result
+    print('# %s %s' % (date, item))
+    print('# ' + text.replace('\n', '\n# '))
+    print_rows(row[-2:] for row in votes)
+
+def session(index, args):
+    print_rows(index.session_votes(args.date, args.vote))
+
+parser = argparse.ArgumentParser(description='Query index of City Council\'s voting archive')
+parser.add_argument('--index', action='store', help='index file (default from config)')
+commands = parser.add_subparsers(dest='command', required=True)
+
+command = commands.add_parser('reindex', help='index stored sessions, unchanged files are skipped')
+command.set_defaults(func=reindex)
+
+command = commands.add_parser('members', help='list members')
+command.add_argument('pattern', nargs='?', help='part of name')
+command.set_defaults(func=members)
+
+command = commands.add_parser('member', help='votes of member: date, resolution ID, item, resolution number, item name, member, vote')
+command.add_argument('name', help='name or part of it')
+command.add_argument('--since', action='store', help='first date (YYYY-MM-DD)')
+command.add_argument('--until', action='store', help='last date (YYYY-MM-DD)')
+command.add_argument('--vote', action='store', choices=voting.VOTES, help='only votes of given option')
+command.add_argument('--summary', action='store_true', help='print only number of votes of every option')
+command.set_defaults(func=member)
+
+command = commands.add_parser('resolution', help='text of resolution and votes of members')
+command.add_argument('id', type=int, help='resolution ID')
+command.set_defaults(func=resolution)
+
+command = commands.add_parser('session', help='votes of all resolutions of session')
+command.add_argument('date', help='date of session (YYYY-MM-DD)')
+command.add_argument('--vote', action='store', choices=voting.VOTES, help='only votes of given option')
+command.set_defaults(func=session)
+
+args = parser.parse_args()
+
+location = os.path.dirname(os.path.realpath(__file__))
+try:
+    config = toml.load(location + '/config.toml')
+except:
+    print('Config file is missing. Exiting...', file=sys.stderr)
+    exit(EXIT_MISSING_CONFIG)
+
+index = VotingIndex(args.index or location + '/' + config.get('index', 'backup/hlasovani.sqlite'))
+try:
+    args.func(index, args)
+finally:
+    index.close()
@@ -4,6 +4,8 @@ This script is used for automatic publication of Evmapy datas
 into CKAN
 """
 import os
+import sys
+import glob
 import argparse
 from datetime import datetime
 import logging
@@ -11,30 +13,56 @@ import xml.etree.ElementTree as ET
 import requests
 import toml
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from common.pool import ordered_map
+from common.manifest import Manifest
+from common import cache as response_cache
+from common import connections
+from common.publish import atomic_write
+from common.ckan import datapusher_push
+from common import ckan as ckan_client
+from common.datasets import Publisher
+from common import voting
+from common.voting_index import VotingIndex
+from common import metrics as run_metrics
+
 EXIT_REQUEST_ERROR = 1
 EXIT_ROLLBACK_SUCCESS = 2
 EXIT_ROLLBACK_ERROR = 3
 EXIT_NOTHING_TO_UPLOAD = 4
 EXIT_MISSING_CONFIG = 5
 
-def get_data(path, id):
-    """Scrape data from web"""
+# Level of uredni-deska.log, orchestrator logs the script with it too
+LOG_LEVEL = logging.INFO
+
+# Timings and counters of run, disabled unless metrics_dir is configured
+metrics = run_metrics.NULL
+# SQLite index of stored sessions, None if it is disabled
+index = None
+
+def fetch_session(session, id):
+    """Downloads City Council's session, returns None if there is no session with given ID yet"""
     data = {'fIDS': id}
-    with requests.Session() as session:
-        try:
-            request = session.post(config['request_url'], data = data)
-        except requests.exceptions.ConnectionError as e:
-            logging.error(e)
-            logging.error('Request for retrieving table data failed. Exiting...')
-            exit(EXIT_REQUEST_ERROR)
-        except requests.exceptions.HTTPError as e:
-            logging.error(e)
-            logging.error('Request for retrieving table data failed. Exiting...')
-            exit(EXIT_REQUEST_ERROR)
-        except requests.exceptions.RequestException as e:
-            logging.error(e)
-            logging.error('Request for retrieving table data failed. Exiting...')
-            exit(EXIT_REQUEST_ERROR)
+    try:
+        # Published session never changes, missing one is not cached
+        # Export is a query, it can be repeated after failure although it is POST
+        with metrics.stage('fetch'):
+            request = cache.fetch(session, 'POST', config['request_url'], immutable=True,
+                                  valid=lambda r: b'<schuze' in r.content, data = data, idempotent=True)
+        request.raise_for_status()
+    # Transient errors were already retried by session, these are permanent
+    except requests.exceptions.ConnectionError as e:
+        logging.error(e)
+        logging.error('Request for retrieving table data failed. Exiting...')
+        exit(EXIT_REQUEST_ERROR)
+    except requests.exceptions.HTTPError as e:
+        logging.error(e)
+        logging.error('Request for retrieving table data failed. Exiting...')
+        exit(EXIT_REQUEST_ERROR)
+    except requests.exceptions.RequestException as e:
+        logging.error(e)
+        logging.error('Request for retrieving table data failed. Exiting...')
+        exit(EXIT_REQUEST_ERROR)
 
     request.encoding = request.apparent_encoding
     #soup = BeautifulSoup(raw_table.content, features='lxml')
@@ -42,136 +70,256 @@ def get_data(path, id):
     try:
         root = ET.fromstring(request.text)
     except ET.ParseError:
-        logging.info('There is no dataset with given ID yet. Nothing to upload. Exiting...')
-        exit(EXIT_NOTHING_TO_UPLOAD)
+        return None
+
+    if root.tag != 'schuze':
+        return None
+    return root
 
+def save_session(path, root):
+    """Stores session into file named by its date"""
     #print(ET.tostring(root))
     date = datetime.strptime(root[0].text, '%d.%m.%Y').strftime('%Y-%m-%d')
     tree = ET.ElementTree(root)
     filename = config['filename'] + str(date) + ".xml"
-    tree.write(path + '/'  + filename)
+    # Published file is never left half written
+    with metrics.stage('write'):
+        atomic_write(path + '/'  + filename, tree.write)
+    metrics.count('sessions_total')
+    if index is not None:
+        with metrics.stage('index'):
+            index.update(path + '/' + filename)
     return date, filename
 
+def source_session():
+    """Returns session of export.asp, rate limited and retrying failed requests"""
+    return metrics.instrument(connections.session(config.get('retries', connections.RETRIES),
+                                                  config.get('rate_limit')))
 
-def ckan_post_request(url, action, data, headers, filename):
+def get_data(path, id):
+    """Scrape data from web"""
+    with source_session() as session:
+        root = fetch_session(session, id)
+
+    if root is None:
+        logging.info('There is no dataset with given ID yet. Nothing to upload. Exiting...')
+        exit(EXIT_NOTHING_TO_UPLOAD)
+
+    return save_session(path, root)
+
+def discover(session, start_id):
     """
-        Wrapper around request call to provide neccessary parameters.
+        Finds ID of newest published session. IDs are assigned sequentially, so
+        we probe start_id + 1, 3, 7, 15... until a missing one is hit and then
+        binary search between last existing and first missing ID.
+        Returns newest ID (start_id - 1 if there is nothing new) and dictionary
+        of sessions downloaded while probing, so they are not fetched twice.
     """
-    if filename:
-        files=[('upload', open(filename, 'rb'))]
-    else:
-        files=None
+    probed = {}
+
+    def exists(id):
+        logging.info('Probing %s', id)
+        probed[id] = fetch_session(session, id)
+        return probed[id] is not None
+
+    if not exists(start_id):
+        return start_id - 1, probed
+
+    low, step = start_id, 1
+    high = low + step
+    while exists(high):
+        low = high
+        step *= 2
+        high = low + step
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        if exists(middle):
+            low = middle
+        else:
+            high = middle
+
+    return low, probed
+
+def publish(date, filename):
+    """Uploads stored session into CKAN"""
+    package = publisher.package(config['package'] + str(date), config['package_name'] + str(date))
+    if package is None:
+        logging.error('Exiting...')
+        exit(1)
+
+    extension = os.path.splitext(filename)[1][1:].upper()
+    with metrics.stage('upload'):
+        publisher.upload(package, config['package_name'] + str(date), location + '/' + filename, extension, 'upload')
+
+def upload_table(package, name, filename):
+    """Uploads CSV table into resource of dataset, returns resource ID if it was uploaded"""
+    resource_id = publisher.upload(package, name, filename, 'CSV', 'tables')
+    if resource_id is None:
+        logging.error('Couldn\'t upload %s, exiting...', filename)
+        exit(EXIT_REQUEST_ERROR)
+    return resource_id
+
+def stored_sessions():
+    return sorted(glob.glob(location + '/' + config['filename'] + '*' + config['extension']))
+
+def publish_tables():
+    """
+        Converts all stored sessions into tables of sessions, agenda items,
+        resolutions and votes and uploads changed ones as CSV resources of
+        one dataset, so they can be queried in DataStore.
+    """
+    tables = config['tables']
+    sources = stored_sessions()
+    logging.info('Converting %s sessions into tables', len(sources))
+    with metrics.stage('convert'):
+        filenames = voting.convert(sources, location + '/' + tables.get('directory', 'backup/tables/'))
+
+    package = publisher.package(tables['package'], tables['package_name'])
+    if package is None:
+        logging.error('Exiting...')
+        exit(EXIT_REQUEST_ERROR)
+
+    pushed_resources = set()
+    with metrics.stage('upload'):
+        for table, filename in filenames.items():
+            resource_id = upload_table(package, voting.TITLES[table], filename)
+            if resource_id:
+                pushed_resources.add(resource_id)
+
+    # Tables are already published, failed ingestion is only reported
+    if pushed_resources and tables.get('datapusher', True):
+        with metrics.stage('datapusher'):
+            pushed = datapusher_push(config['url_api'], config['apikey'], pushed_resources,
+                                     timeout=tables.get('datapusher_timeout', 600), session=ckan.session)
+        if not pushed:
+            logging.error('Some tables were not ingested into DataStore')
+
+def discover_and_publish(location):
+    """Publishes every session newer than the one stored in state file"""
+    state_file = location + '/' + config.get('state_file', '.ID')
     try:
-        r = requests.post(url + action,
-                          data=data,
-                          headers=headers,
-                          files=files)
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        logging.error(e)
-        return EXIT_REQUEST_ERROR
-    except requests.exceptions.RequestException as e:
-        return EXIT_REQUEST_ERROR
+        with open(state_file) as f:
+            start_id = int(f.read())
+    except (OSError, ValueError):
+        logging.error('State file %s is missing or broken. Exiting...', state_file)
+        exit(EXIT_MISSING_CONFIG)
+
+    workers = config.get('workers', 4)
+    with source_session() as session:
 
-    if action in ['package_show', 'package_create']:
-        return r
-    else:
-        return 0
+        newest_id, probed = discover(session, start_id)
+        if newest_id < start_id:
+            logging.info('There is no dataset with given ID yet. Nothing to upload. Exiting...')
+            exit(EXIT_NOTHING_TO_UPLOAD)
+        logging.info('Sessions %s-%s are missing', start_id, newest_id)
 
-parser = argparse.ArgumentParser(description='Import datas of City Council\'s Voting to CKAN')
+        def fetch(id):
+            if id in probed:
+                return id, probed[id]
+            logging.info('Processing %s', id)
+            return id, fetch_session(session, id)
 
-parser.add_argument('-sid', '--start-id', action='store', type=int, required='True', help='starting id of import')
-parser.add_argument('-eid', '--end-id', action='store', type=int, required='True',help='end id of import')
+        for id, root in ordered_map(fetch, range(start_id, newest_id + 1), workers):
+            if root is None:
+                logging.info('Skipping %s - no dataset with given ID', id)
+                continue
+            date, filename = save_session(location, root)
+            publish(date, filename)
 
-args = parser.parse_args()
+    # Store ID for next check
+    with open(state_file + '.tmp', 'w') as f:
+        f.write(str(newest_id + 1) + '\n')
+    os.replace(state_file + '.tmp', state_file)
 
-dirname = os.path.realpath(__file__)
-location = dirname.rsplit('/',1)[0]
-filename = location + '/config.toml'
+def main(argv=None):
+    """Imports City Council's sessions given by arguments into CKAN, metrics are written at the end"""
+    code = EXIT_REQUEST_ERROR
+    try:
+        run(argv)
+        code = 0
+    except SystemExit as e:
+        code = e.code or 0
+        raise
+    finally:
+        metrics.finish(code if isinstance(code, int) else EXIT_REQUEST_ERROR)
 
-logging.basicConfig(filename=location + "/uredni-deska.log", level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+def run(argv):
+    global config, location, cache, ckan, publisher, metrics, index
 
-try:
-    config = toml.load(filename)
-except:
-    logging.error("Config file is missing. Exiting...")
-    exit(EXIT_MISSING_CONFIG)
+    parser = argparse.ArgumentParser(description='Import datas of City Council\'s Voting to CKAN')
 
-if ((len(str(args.start_id)) > 4) or (len(str(args.end_id)) > 4)):
-    logging.error('Given year does not has 4 digits. Exiting...')
-    exit(1)
+    parser.add_argument('-sid', '--start-id', action='store', type=int, help='starting id of import')
+    parser.add_argument('-eid', '--end-id', action='store', type=int, help='end id of import')
+    parser.add_argument('--discover', action='store_true', help='import all sessions newer than ID stored in state file and update it')
+    parser.add_argument('--convert', action='store_true', help='only index all stored sessions, convert them into tables and publish them')
+    parser.add_argument('--no-cache', action='store_true', help='do not use cache of downloaded data')
 
-if args.start_id > args.end_id:
-    logging.error('Starting id has to be smaller than ending id. Exiting...')
-    exit(1)
+    args = parser.parse_args(argv)
 
-logging.debug('Arguments parsed.')
+    dirname = os.path.realpath(__file__)
+    location = dirname.rsplit('/',1)[0]
+    filename = location + '/config.toml'
 
-for id in range(args.start_id, args.end_id + 1):
-    logging.info('Processing %s', id)
-    date, filename = get_data(location, id)
+    logging.basicConfig(filename=location + "/uredni-deska.log", level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    # Check if package exists
     try:
-        data={'id': config['package'] + str(date)}
-        headers={'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'package_show', data, headers, None)
-        data = r.json()
+        config = toml.load(filename)
     except:
-        logging.info('Dataset %s does not exists', config['package'] + str(date))
-
-    # dataset does not exists or is deleted, create one
-    if r == EXIT_REQUEST_ERROR or data['result']['state'] == 'deleted':
-        logging.info('Creating dataset %s', config['package'] + str(id))
-        data = {
-            'name': config['package'] + str(date),
-            'title': config['package_name'] + str(date),
-            'private': False,
-            'url': 'upload',  # Needed to pass validation,
-            'owner_org': config['owner_org']
-        }
-        headers = {'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'package_create', data, headers, None)
-
-        if r == EXIT_REQUEST_ERROR:
-            logging.error('Couldn\'t create dataset %s, exiting...', config['package'] + str(date))
-            exit(1)
-
-        data = r.json()
-
-    # we have id of package that will be updated
-    package_id = data['result']['id']
-
-    resource_id = ''
-    for resource in data['result']['resources']:
-        if resource['name'] == config['package_name'] + str(date):
-            resource_id = resource['id']
-
-    path = os.path.join(filename)
-    extension = os.path.splitext(filename)[1][1:].upper()
-    resource_name = '{extension} file'.format(extension=extension)
-    if resource_id == '':
-        logging.info('Creating "{resource_name}" resource'.format(**locals()))
-        data = {
-            'package_id': package_id,
-            'name': config['package_name'] + str(date),
-            'format': extension,
-            'url': 'upload',  # Needed to pass validation
-        }
-        headers = {'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'resource_create', data, headers, location + '/' +filename)
-
-    else:
-        logging.info('Updating "{resource_name}" resource'.format(**locals()))
-        data = {
-            'id': resource_id,
-            'package_id': package_id,
-            'name': config['package_name'] + str(date),
-            'format': extension,
-            'url': 'upload',  # Needed to pass validation
-        }
-        headers = {'Authorization': config['apikey']}
-        r = ckan_post_request(config['url_api'], 'resource_update', data, headers, location + '/' + filename)
-
-logging.info('All datas successfully imported.')
+        logging.error("Config file is missing. Exiting...")
+        exit(EXIT_MISSING_CONFIG)
+
+    metrics = run_metrics.from_config('uredni-deska', location, config)
+    ckan = ckan_client.from_config(location, config, metrics)
+    publisher = Publisher(config, ckan, Manifest(location + '/' + config.get('manifest', 'backup/.manifest.json')),
+                          metrics=metrics)
+    cache = response_cache.from_config(location, config, not args.no_cache)
+    # Index is updated with every stored session, query.py reads it
+    if config.get('index'):
+        index = VotingIndex(location + '/' + config['index'])
+
+    tables = config.get('tables', {}).get('enabled')
+    if args.convert:
+        if not tables and index is None:
+            logging.error('Neither tables nor index are enabled in config. Exiting...')
+            exit(EXIT_MISSING_CONFIG)
+        if index is not None:
+            with metrics.stage('index'):
+                logging.info('%s sessions indexed', index.sync(stored_sessions()))
+        if tables:
+            publish_tables()
+        logging.info('All tables successfully published.')
+        exit(0)
+
+    if args.discover:
+        discover_and_publish(location)
+        if tables:
+            publish_tables()
+        logging.info('All datas successfully imported.')
+        exit(0)
+
+    if args.start_id is None or args.end_id is None:
+        logging.error('Starting and ending id or --discover has to be given. Exiting...')
+        exit(1)
+
+    if ((len(str(args.start_id)) > 4) or (len(str(args.end_id)) > 4)):
+        logging.error('Given year does not has 4 digits. Exiting...')
+        exit(1)
+
+    if args.start_id > args.end_id:
+        logging.error('Starting id has to be smaller than ending id. Exiting...')
+        exit(1)
+
+    logging.debug('Arguments parsed.')
+
+    for id in range(args.start_id, args.end_id + 1):
+        logging.info('Processing %s', id)
+        date, filename = get_data(location, id)
+        publish(date, filename)
+
+    if tables:
+        publish_tables()
+    logging.info('All datas successfully imported.')
 
+if __name__ == '__main__':
+    main()